@@ -52,6 +52,13 @@ class HumanoidAMP(Humanoid):
         self._num_amp_obs_enc_steps = cfg["env"].get("numAMPEncObsSteps", self._num_amp_obs_steps)
 
         self._equal_motion_weights = cfg["env"].get("equal_motion_weights", False)
+        self._bake_motions = cfg["env"].get("bake_motions", False)
+        self._motion_cache_dir = cfg["env"].get("motion_cache_dir", None)
+        self._motion_load_workers = cfg["env"].get("motion_load_workers", 0)
+        self._motion_shard_frames = cfg["env"].get("motion_shard_frames", 0)
+        self._motion_resident_shards = cfg["env"].get("motion_resident_shards", 4)
+        self._motion_shard_swap_interval = cfg["env"].get("motion_shard_swap_interval", 100)
+        self._use_amp_obs_demo_bank = cfg["env"].get("amp_obs_demo_bank", False)
         assert(self._num_amp_obs_steps >= 2)
 
         self._reset_default_env_ids = []
@@ -123,6 +130,20 @@ class HumanoidAMP(Humanoid):
         return motion_ids, enc_motion_times, enc_amp_obs_demo_flat
 
     def fetch_amp_obs_demo_enc_pair(self, num_samples):
+        motion_ids, enc_motion_times, enc_amp_obs_demo_flat = self.fetch_amp_obs_demo_enc(num_samples)
+
+        # sub-window-size is for the amp_obs contained within the enc-amp-obs. make sure we sample only within the valid portion of the motion
+        enc_window_size = self.dt * (self._num_amp_obs_enc_steps - 1)
+        sub_window_size = torch.clip(self._motion_lib._motion_lengths[motion_ids], max=enc_window_size) - self.dt * self._num_amp_obs_steps
+        motion_times = enc_motion_times - torch.rand(enc_motion_times.shape, device=self.device) * sub_window_size
+
+        amp_obs_demo = self.build_amp_obs_demo(motion_ids, motion_times, self._num_amp_obs_steps).view(-1, self._num_amp_obs_steps, self._num_amp_obs_per_step)
+        amp_obs_demo_flat = amp_obs_demo.to(self.device).view(-1, self.get_num_amp_obs())
+
+        return motion_ids, enc_motion_times, enc_amp_obs_demo_flat, motion_times, amp_obs_demo_flat
+
+    def fetch_amp_obs_demo_enc(self, num_samples):
+        # only the encoder windows of fetch_amp_obs_demo_enc_pair, for callers that do not use the amp obs
         motion_ids = self._motion_lib.sample_motions(num_samples)
 
         # since negative times are added to these values in build_amp_obs_demo,
@@ -133,17 +154,10 @@ class HumanoidAMP(Humanoid):
         # make sure not to add more than motion clip length, negative amp_obs will show zero index amp_obs instead
         enc_motion_times += torch.clip(self._motion_lib._motion_lengths[motion_ids], max=enc_window_size)
 
-        # sub-window-size is for the amp_obs contained within the enc-amp-obs. make sure we sample only within the valid portion of the motion
-        sub_window_size = torch.clip(self._motion_lib._motion_lengths[motion_ids], max=enc_window_size) - self.dt * self._num_amp_obs_steps
-        motion_times = enc_motion_times - torch.rand(enc_motion_times.shape, device=self.device) * sub_window_size
-
         enc_amp_obs_demo = self.build_amp_obs_demo(motion_ids, enc_motion_times, self._num_amp_obs_enc_steps).view(-1, self._num_amp_obs_enc_steps, self._num_amp_obs_per_step)
-        amp_obs_demo = self.build_amp_obs_demo(motion_ids, motion_times, self._num_amp_obs_steps).view(-1, self._num_amp_obs_steps, self._num_amp_obs_per_step)
-
         enc_amp_obs_demo_flat = enc_amp_obs_demo.to(self.device).view(-1, self.get_num_enc_amp_obs())
-        amp_obs_demo_flat = amp_obs_demo.to(self.device).view(-1, self.get_num_amp_obs())
 
-        return motion_ids, enc_motion_times, enc_amp_obs_demo_flat, motion_times, amp_obs_demo_flat
+        return motion_ids, enc_motion_times, enc_amp_obs_demo_flat
 
     def fetch_amp_obs_demo_pair(self, num_samples):
         motion_ids = self._motion_lib.sample_motions(num_samples)
@@ -170,7 +184,42 @@ class HumanoidAMP(Humanoid):
 
         return motion_ids, motion_times0, amp_obs_demo0_flat, motion_times1, amp_obs_demo1_flat
 
+    def get_amp_obs_demo_enc_windows(self, window_stride=1):
+        # the end times of the encoder windows of every clip, window_stride steps apart,
+        # covering the same range as the windows sampled in fetch_amp_obs_demo_enc_pair
+        motion_lib = self._motion_lib
+        enc_window_size = self.dt * (self._num_amp_obs_enc_steps - 1)
+        window_dt = self.dt * window_stride
+
+        motion_lengths = motion_lib.get_motion_length(motion_lib.motion_ids)
+        first_times = torch.clip(motion_lengths, max=enc_window_size)
+        num_windows = torch.floor((motion_lengths - first_times) / window_dt + 1e-5).long() + 1
+        window_starts = torch.cumsum(num_windows, dim=0) - num_windows
+        total_windows = int(num_windows.sum())
+
+        motion_ids = torch.repeat_interleave(motion_lib.motion_ids, num_windows)
+        window_ids = torch.arange(total_windows, dtype=torch.long, device=self.device) - window_starts[motion_ids]
+        motion_times = first_times[motion_ids] + window_ids * window_dt
+        return motion_ids, motion_times
+
+    def get_amp_obs_demo_clip_windows(self, num_clip_windows=1):
+        # the end times of num_clip_windows encoder windows evenly spread over every clip,
+        # a single window is placed in the middle of the clip
+        motion_lib = self._motion_lib
+        enc_window_size = self.dt * self._num_amp_obs_enc_steps
+
+        motion_lengths = motion_lib.get_motion_length(motion_lib.motion_ids)
+        first_times = torch.clip(motion_lengths, max=enc_window_size)
+        window_offsets = (torch.arange(num_clip_windows, dtype=torch.float32, device=self.device) + 0.5) / num_clip_windows
+
+        motion_ids = torch.repeat_interleave(motion_lib.motion_ids, num_clip_windows)
+        motion_times = first_times.unsqueeze(-1) + (motion_lengths - first_times).unsqueeze(-1) * window_offsets
+        return motion_ids, motion_times.view(-1)
+
     def build_amp_obs_demo(self, motion_ids, motion_times0, num_steps):
+        if self._amp_obs_demo_bank is not None:
+            return self._fetch_amp_obs_demo_bank(motion_ids, motion_times0, num_steps)
+
         dt = self.dt
 
         motion_ids = torch.tile(motion_ids.unsqueeze(-1), [1, num_steps])
@@ -180,6 +229,19 @@ class HumanoidAMP(Humanoid):
 
         motion_ids = motion_ids.view(-1)
         motion_times = motion_times.view(-1)
+        amp_obs_demo = self._compute_amp_obs_demo(motion_ids, motion_times)
+        return amp_obs_demo
+
+    def _compute_amp_obs_demo(self, motion_ids, motion_times):
+        if self._bake_motions:
+            frames, blend = self._motion_lib.get_baked_frames(motion_ids, motion_times)
+            if frames is not None:
+                amp_obs_demo = build_amp_observations_from_frames(frames, blend, self._motion_lib.get_baked_pose_size(),
+                                                                  self.num_dof, self._local_root_obs, self._root_height_obs,
+                                                                  self._demo_dof3_cols, self._demo_dof1_cols,
+                                                                  self._demo_dof_obs_perm)
+                return amp_obs_demo
+
         root_pos, root_rot, dof_pos, root_vel, root_ang_vel, dof_vel, key_pos \
             = self._motion_lib.get_motion_state(motion_ids, motion_times)
         amp_obs_demo = build_amp_observations(root_pos, root_rot, root_vel, root_ang_vel,
@@ -188,6 +250,47 @@ class HumanoidAMP(Humanoid):
                                               self._dof_obs_size, self._dof_offsets)
         return amp_obs_demo
 
+    def _build_amp_obs_demo_bank(self):
+        # the AMP observation of every clip at every multiple of dt, so that demo windows become a gather
+        motion_lib = self._motion_lib
+        motion_lengths = motion_lib.get_motion_length(motion_lib.motion_ids)
+        num_bank_frames = torch.floor(motion_lengths / self.dt + 1e-5).long() + 1
+        bank_starts = torch.cumsum(num_bank_frames, dim=0) - num_bank_frames
+        total_frames = int(num_bank_frames.sum())
+
+        bank_motion_ids = torch.repeat_interleave(motion_lib.motion_ids, num_bank_frames)
+        bank_frame_ids = torch.arange(total_frames, dtype=torch.long, device=self.device) - bank_starts[bank_motion_ids]
+        bank_times = torch.min(bank_frame_ids * self.dt, motion_lengths[bank_motion_ids])
+
+        self._amp_obs_demo_bank = None
+        bank = torch.zeros((total_frames, self._num_amp_obs_per_step), dtype=torch.float32, device=self.device)
+        chunk_size = 65536
+        for start in range(0, total_frames, chunk_size):
+            end = min(start + chunk_size, total_frames)
+            bank[start:end] = self._compute_amp_obs_demo(bank_motion_ids[start:end], bank_times[start:end])
+
+        self._amp_obs_demo_bank = bank
+        self._amp_obs_demo_bank_starts = bank_starts
+        self._amp_obs_demo_bank_frames = num_bank_frames
+
+        print("Built AMP observation bank with {:d} frames ({:.1f} MB)".format(
+              total_frames, bank.numel() * bank.element_size() / (1024 * 1024)))
+        return
+
+    def _fetch_amp_obs_demo_bank(self, motion_ids, motion_times0, num_steps):
+        # the window end is snapped to the nearest bank frame, each step goes back one bank frame
+        motion_ids = motion_ids.to(self.device)
+        num_bank_frames = self._amp_obs_demo_bank_frames[motion_ids]
+        frame_ids = torch.round(motion_times0.to(self.device) / self.dt).long()
+        frame_ids = torch.min(torch.clamp(frame_ids, min=0), num_bank_frames - 1)
+
+        time_steps = torch.arange(0, num_steps, dtype=torch.long, device=self.device)
+        frame_ids = torch.clamp(frame_ids.unsqueeze(-1) - time_steps, min=0)
+        rows = self._amp_obs_demo_bank_starts[motion_ids].unsqueeze(-1) + frame_ids
+
+        amp_obs_demo = self._amp_obs_demo_bank[rows.view(-1)]
+        return amp_obs_demo
+
     def _build_amp_obs_demo_buf(self, num_samples):
         self._amp_obs_demo_buf = torch.zeros((num_samples, self._num_amp_obs_steps, self._num_amp_obs_per_step), device=self.device, dtype=torch.float32)
         self._enc_amp_obs_demo_buf = torch.zeros((num_samples, self._num_amp_obs_enc_steps, self._num_amp_obs_per_step), device=self.device, dtype=torch.float32)
@@ -216,7 +319,46 @@ class HumanoidAMP(Humanoid):
                                      dof_offsets=self._dof_offsets,
                                      key_body_ids=self._key_body_ids.cpu().numpy(),
                                      equal_motion_weights=self._equal_motion_weights,
-                                     device=self.device)
+                                     device=self.device,
+                                     baked=self._bake_motions,
+                                     cache_dir=self._motion_cache_dir,
+                                     num_workers=self._motion_load_workers,
+                                     shard_frames=self._motion_shard_frames,
+                                     resident_shards=self._motion_resident_shards,
+                                     shard_swap_interval=self._motion_shard_swap_interval)
+
+        if self._bake_motions:
+            self._build_demo_dof_index()
+
+        self._amp_obs_demo_bank = None
+        if self._use_amp_obs_demo_bank:
+            assert(self._motion_shard_frames == 0), "amp_obs_demo_bank requires all motions to be resident"
+            self._build_amp_obs_demo_bank()
+        return
+
+    def _build_demo_dof_index(self):
+        # dof columns of the 3-dof and 1-dof joints, and the permutation that puts their
+        # observations back into joint order, used when building demo observations from baked frames
+        dof3_cols = []
+        dof1_cols = []
+        joints3 = []
+        joints1 = []
+        for j in range(len(self._dof_offsets) - 1):
+            dof_offset = self._dof_offsets[j]
+            dof_size = self._dof_offsets[j + 1] - dof_offset
+            if (dof_size == 3):
+                dof3_cols += list(range(dof_offset, dof_offset + dof_size))
+                joints3.append(j)
+            elif (dof_size == 1):
+                dof1_cols.append(dof_offset)
+                joints1.append(j)
+            else:
+                assert False, "Unsupported joint type"
+
+        joint_perm = np.argsort(joints3 + joints1)
+        self._demo_dof3_cols = torch.tensor(dof3_cols, dtype=torch.long, device=self.device)
+        self._demo_dof1_cols = torch.tensor(dof1_cols, dtype=torch.long, device=self.device)
+        self._demo_dof_obs_perm = torch.tensor(joint_perm, dtype=torch.long, device=self.device)
         return
     
     def _reset_envs(self, env_ids):
@@ -410,3 +552,82 @@ def build_amp_observations(root_pos, root_rot, root_vel, root_ang_vel, dof_pos,
     dof_obs = dof_to_obs(dof_pos, dof_obs_size, dof_offsets)
     obs = torch.cat((root_h_obs, root_rot_obs, local_root_vel, local_root_ang_vel, dof_obs, dof_vel, flat_local_key_pos), dim=-1)
     return obs
+
+@torch.jit.script
+def quat_to_tan_norm_closed_form(q):
+    # type: (Tensor) -> Tensor
+    # same as torch_utils.quat_to_tan_norm, using the first and last column of the rotation matrix
+    x = q[..., 0]
+    y = q[..., 1]
+    z = q[..., 2]
+    w = q[..., 3]
+    tan = torch.stack([1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y + w * z), 2.0 * (x * z - w * y)], dim=-1)
+    norm = torch.stack([2.0 * (x * z + w * y), 2.0 * (y * z - w * x), 1.0 - 2.0 * (x * x + y * y)], dim=-1)
+    return torch.cat([tan, norm], dim=-1)
+
+@torch.jit.script
+def rotate_heading(v, cos_heading, sin_heading):
+    # type: (Tensor, Tensor, Tensor) -> Tensor
+    # rotates v by the inverse of the heading rotation around the z axis
+    x = cos_heading * v[..., 0] + sin_heading * v[..., 1]
+    y = -sin_heading * v[..., 0] + cos_heading * v[..., 1]
+    return torch.stack([x, y, v[..., 2]], dim=-1)
+
+@torch.jit.script
+def build_amp_observations_from_frames(frames, blend, pose_size, num_dof, local_root_obs, root_height_obs,
+                                       dof3_cols, dof1_cols, dof_obs_perm):
+    # type: (Tensor, Tensor, int, int, bool, bool, Tensor, Tensor, Tensor) -> Tensor
+    # builds the same observations as build_amp_observations directly from baked motion frames
+    num_samples = frames.shape[0]
+    pose = torch.lerp(frames[:, :pose_size], frames[:, pose_size:(2 * pose_size)], blend.unsqueeze(-1))
+    vel = frames[:, (2 * pose_size):]
+
+    root_pos = pose[:, 0:3]
+    root_rot = torch.nn.functional.normalize(pose[:, 3:7], dim=-1)
+    dof_pos = pose[:, 7:(7 + num_dof)]
+    key_body_pos = pose[:, (7 + num_dof):].view(num_samples, -1, 3)
+    root_vel = vel[:, 0:3]
+    root_ang_vel = vel[:, 3:6]
+    dof_vel = vel[:, 6:]
+
+    # the heading is the direction of the rotated x axis on the xy plane, which is the tangent of the root rotation
+    root_tan_norm = quat_to_tan_norm_closed_form(root_rot)
+    heading_len = torch.sqrt(root_tan_norm[:, 0] * root_tan_norm[:, 0] + root_tan_norm[:, 1] * root_tan_norm[:, 1])
+    valid_heading = heading_len > 1e-8
+    cos_heading = torch.where(valid_heading, root_tan_norm[:, 0] / heading_len, torch.ones_like(heading_len))
+    sin_heading = torch.where(valid_heading, root_tan_norm[:, 1] / heading_len, torch.zeros_like(heading_len))
+
+    if local_root_obs:
+        root_rot_obs = torch.cat([rotate_heading(root_tan_norm[:, 0:3], cos_heading, sin_heading),
+                                  rotate_heading(root_tan_norm[:, 3:6], cos_heading, sin_heading)], dim=-1)
+    else:
+        root_rot_obs = root_tan_norm
+
+    root_h = root_pos[:, 2:3]
+    if not root_height_obs:
+        root_h_obs = torch.zeros_like(root_h)
+    else:
+        root_h_obs = root_h
+
+    local_root_vel = rotate_heading(root_vel, cos_heading, sin_heading)
+    local_root_ang_vel = rotate_heading(root_ang_vel, cos_heading, sin_heading)
+
+    local_key_body_pos = key_body_pos - root_pos.unsqueeze(-2)
+    local_key_body_pos = rotate_heading(local_key_body_pos, cos_heading.unsqueeze(-1), sin_heading.unsqueeze(-1))
+    flat_local_key_pos = local_key_body_pos.view(num_samples, -1)
+
+    # blended dofs are not wrapped, exp maps and angles off by a full turn give the same rotation
+    joint_q = torch_utils.exp_map_to_quat(dof_pos[:, dof3_cols].view(num_samples, -1, 3))
+    dof3_obs = quat_to_tan_norm_closed_form(joint_q)
+
+    # 1-dof joints rotate around the y axis
+    theta = dof_pos[:, dof1_cols]
+    cos_theta = torch.cos(theta)
+    sin_theta = torch.sin(theta)
+    zeros = torch.zeros_like(theta)
+    dof1_obs = torch.stack([cos_theta, zeros, -sin_theta, sin_theta, zeros, cos_theta], dim=-1)
+
+    dof_obs = torch.cat([dof3_obs, dof1_obs], dim=1)[:, dof_obs_perm].view(num_samples, -1)
+
+    obs = torch.cat((root_h_obs, root_rot_obs, local_root_vel, local_root_ang_vel, dof_obs, dof_vel, flat_local_key_pos), dim=-1)
+    return obs
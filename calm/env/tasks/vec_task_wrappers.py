@@ -73,5 +73,8 @@ class VecTaskPythonWrapper(VecTaskPython):
     def fetch_amp_obs_demo_enc_pair(self, num_samples):
         return self.task.fetch_amp_obs_demo_enc_pair(num_samples)
 
+    def fetch_amp_obs_demo_enc(self, num_samples):
+        return self.task.fetch_amp_obs_demo_enc(num_samples)
+
     def fetch_amp_obs_demo_per_id(self, num_samples, motion_ids):
         return self.task.fetch_amp_obs_demo_per_id(num_samples, motion_ids)
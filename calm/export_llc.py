@@ -0,0 +1,66 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import os
+import yaml
+
+from learning import llc_export
+
+"""
+Exports the low-level controller of a trained CALM checkpoint into a frozen TorchScript module, which
+HRL training and playback load with --llc_frozen_checkpoint in place of --llc_checkpoint, e.g.
+
+python calm/export_llc.py --llc_config calm/data/cfg/train/rlg/calm_humanoid.yaml --checkpoint output/Humanoid.pth --dtype float16
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a CALM low-level controller into a frozen inference module")
+    parser.add_argument("--llc_config", type=str, required=True,
+                        help="Training config of the low-level controller")
+    parser.add_argument("--checkpoint", type=str, required=True,
+                        help="Checkpoint of the low-level controller")
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the exported module, defaults to the checkpoint with the _frozen.pt suffix")
+    parser.add_argument("--dtype", type=str, default="float32", choices=list(llc_export.FROZEN_LLC_DTYPES.keys()),
+                        help="Precision of the exported layers, the input normalization is always done in float32")
+    args = parser.parse_args()
+
+    output = args.output
+    if (output == ""):
+        output = os.path.splitext(args.checkpoint)[0] + "_frozen.pt"
+
+    with open(args.llc_config, 'r') as f:
+        llc_config = yaml.load(f, Loader=yaml.SafeLoader)
+
+    llc_export.export_llc(llc_config['params'], args.checkpoint, output, llc_export.FROZEN_LLC_DTYPES[args.dtype])
+    print("Exported {:s} LLC to {:s}".format(args.dtype, output))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,12 @@ from torch import nn
 import learning.replay_buffer as replay_buffer
 import learning.common_agent as common_agent
 
+AMP_OBS_STORAGE_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
 
 class AMPAgent(common_agent.CommonAgent):
     def __init__(self, base_name, config):
@@ -196,6 +202,7 @@ class AMPAgent(common_agent.CommonAgent):
         self.dataset.values_dict['amp_obs'] = batch_dict['amp_obs']
         self.dataset.values_dict['amp_obs_demo'] = batch_dict['amp_obs_demo']
         self.dataset.values_dict['amp_obs_replay'] = batch_dict['amp_obs_replay']
+        self.dataset.values_dict['amp_obs_replay_idx'] = batch_dict.get('amp_obs_replay_idx', None)
         
         rand_action_mask = batch_dict['rand_action_mask']
         self.dataset.values_dict['rand_action_mask'] = rand_action_mask
@@ -216,13 +223,16 @@ class AMPAgent(common_agent.CommonAgent):
         
         self._update_amp_demos()
         num_obs_samples = batch_dict['amp_obs'].shape[0]
-        amp_obs_demo = self._amp_obs_demo_buffer.sample(num_obs_samples)['amp_obs']
+        # the sampled views are only used by this epoch's update, before the buffers are sampled again
+        amp_obs_demo = self._amp_obs_demo_buffer.sample(num_obs_samples, copy=False)['amp_obs']
         batch_dict['amp_obs_demo'] = amp_obs_demo
 
         if self._amp_replay_buffer.get_total_count() == 0:
             batch_dict['amp_obs_replay'] = batch_dict['amp_obs']
         else:
-            batch_dict['amp_obs_replay'] = self._amp_replay_buffer.sample(num_obs_samples)['amp_obs']
+            samples = self._amp_replay_buffer.sample(num_obs_samples, copy=False)
+            batch_dict['amp_obs_replay'] = samples['amp_obs']
+            batch_dict['amp_obs_replay_idx'] = samples.get('idx', None)
 
         self.set_train()
 
@@ -361,6 +371,8 @@ class AMPAgent(common_agent.CommonAgent):
             disc_info = self._disc_loss(disc_agent_cat_logit, disc_demo_logit, amp_obs_demo)
             disc_loss = disc_info['disc_loss']
 
+            self._update_amp_replay_priorities(input_dict, disc_agent_replay_logit)
+
             loss = a_loss + self.critic_coef * c_loss - self.entropy_coef * entropy + self.bounds_loss_coef * b_loss \
                  + self._disc_coef * disc_loss
             
@@ -438,6 +450,17 @@ class AMPAgent(common_agent.CommonAgent):
         self._disc_weight_decay = config['disc_weight_decay']
         self._disc_reward_scale = config['disc_reward_scale']
         self._normalize_amp_input = config.get('normalize_amp_input', True)
+
+        # prioritized replay samples replay observations in proportion to how well they still fool the discriminator
+        self._amp_replay_prioritized = config.get('amp_replay_prioritized', False)
+        self._amp_replay_priority_alpha = config.get('amp_replay_priority_alpha', 0.6)
+        self._amp_replay_priority_eps = config.get('amp_replay_priority_eps', 1e-3)
+
+        # AMP observations in the experience, demo and replay buffers can be kept in half precision,
+        # they are converted back to float32 when they are read
+        amp_obs_storage_dtype = config.get('amp_obs_storage_dtype', 'float32')
+        assert(amp_obs_storage_dtype in AMP_OBS_STORAGE_DTYPES), "unsupported amp_obs_storage_dtype: {:s}".format(amp_obs_storage_dtype)
+        self._amp_obs_storage_dtype = AMP_OBS_STORAGE_DTYPES[amp_obs_storage_dtype]
         return
 
     def _build_net_config(self):
@@ -462,6 +485,7 @@ class AMPAgent(common_agent.CommonAgent):
     def _init_train(self):
         super()._init_train()
         self._init_amp_demo_buf()
+        self._print_amp_obs_memory()
         return
 
     def _disc_loss(self, disc_agent_logit, disc_demo_logit, obs_demo):
@@ -503,6 +527,16 @@ class AMPAgent(common_agent.CommonAgent):
         }
         return disc_info
 
+    def _update_amp_replay_priorities(self, input_dict, disc_replay_logit):
+        replay_idx = input_dict.get('amp_obs_replay_idx', None)
+        if self._amp_replay_prioritized and replay_idx is not None:
+            with torch.no_grad():
+                # per sample loss of the replay observations as negatives
+                replay_idx = replay_idx[0:self._amp_minibatch_size]
+                priorities = torch.nn.functional.softplus(disc_replay_logit.detach().float()).view(-1)
+                self._amp_replay_buffer.update_priorities(replay_idx, priorities)
+        return
+
     def _disc_loss_neg(self, disc_logits):
         bce = torch.nn.BCEWithLogitsLoss()
         loss = bce(disc_logits, torch.zeros_like(disc_logits))
@@ -520,6 +554,23 @@ class AMPAgent(common_agent.CommonAgent):
         demo_acc = torch.mean(demo_acc.float())
         return agent_acc, demo_acc
 
+    def _get_amp_obs_keys(self):
+        return ['amp_obs']
+
+    def _get_amp_replay_row_numel(self):
+        return int(np.prod(self._amp_observation_space.shape))
+
+    def _print_amp_obs_memory(self):
+        exp_tensors = [self.experience_buffer.tensor_dict[k] for k in self._get_amp_obs_keys()]
+        exp_bytes = sum([t.numel() * t.element_size() for t in exp_tensors])
+        demo_bytes = self._amp_obs_demo_buffer.get_num_bytes()
+        replay_bytes = self._amp_replay_buffer.get_num_bytes(self._get_amp_replay_row_numel())
+
+        mb = 1024 * 1024
+        print("AMP observation storage ({:s}): experience {:.1f} MB, demo buffer {:.1f} MB, replay buffer {:.1f} MB".format(
+              str(self._amp_obs_storage_dtype), exp_bytes / mb, demo_bytes / mb, replay_bytes / mb))
+        return
+
     def _fetch_amp_obs_demo(self, num_samples):
         amp_obs_demo = self.vec_env.env.fetch_amp_obs_demo(num_samples)
         return amp_obs_demo
@@ -527,15 +578,26 @@ class AMPAgent(common_agent.CommonAgent):
     def _build_amp_buffers(self):
         batch_shape = self.experience_buffer.obs_base_shape
         self.experience_buffer.tensor_dict['amp_obs'] = torch.zeros(batch_shape + self._amp_observation_space.shape,
-                                                                    device=self.ppo_device)
+                                                                    dtype=self._amp_obs_storage_dtype, device=self.ppo_device)
         self.experience_buffer.tensor_dict['rand_action_mask'] = torch.zeros(batch_shape, dtype=torch.float32, device=self.ppo_device)
         
         amp_obs_demo_buffer_size = int(self.config['amp_obs_demo_buffer_size'])
-        self._amp_obs_demo_buffer = replay_buffer.ReplayBuffer(amp_obs_demo_buffer_size, self.ppo_device)
+        self._amp_obs_demo_buffer = replay_buffer.ReplayBuffer(amp_obs_demo_buffer_size, self.ppo_device,
+                                                               dtype=self._amp_obs_storage_dtype)
 
         self._amp_replay_keep_prob = self.config['amp_replay_keep_prob']
         replay_buffer_size = int(self.config['amp_replay_buffer_size'])
-        self._amp_replay_buffer = replay_buffer.ReplayBuffer(replay_buffer_size, self.ppo_device)
+        replay_host_buffer_size = int(self.config.get('amp_replay_host_buffer_size', 0))
+        if self._amp_replay_prioritized:
+            assert(replay_host_buffer_size == 0), "prioritized AMP replay does not support a host buffer"
+            self._amp_replay_buffer = replay_buffer.PrioritizedReplayBuffer(replay_buffer_size, self.ppo_device,
+                                                                            alpha=self._amp_replay_priority_alpha,
+                                                                            eps=self._amp_replay_priority_eps,
+                                                                            dtype=self._amp_obs_storage_dtype)
+        else:
+            self._amp_replay_buffer = replay_buffer.ReplayBuffer(replay_buffer_size, self.ppo_device,
+                                                                 host_buffer_size=replay_host_buffer_size,
+                                                                 dtype=self._amp_obs_storage_dtype)
         
         self._build_rand_action_probs()
         
@@ -558,6 +620,7 @@ class AMPAgent(common_agent.CommonAgent):
         return
 
     def _preproc_amp_obs(self, amp_obs):
+        amp_obs = amp_obs.float()
         if self._normalize_amp_input:
             shape = amp_obs.shape
             amp_obs = amp_obs.view(-1, self.vec_env.env.amp_observation_space.shape[0] // self.vec_env.env.task._num_amp_obs_steps)
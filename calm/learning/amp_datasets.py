@@ -31,16 +31,30 @@ from rl_games.common import datasets
 
 
 class AMPDataset(datasets.PPODataset):
-    def __init__(self, batch_size, minibatch_size, is_discrete, is_rnn, device, seq_len):
+    def __init__(self, batch_size, minibatch_size, is_discrete, is_rnn, device, seq_len, contiguous=False):
         super().__init__(batch_size, minibatch_size, is_discrete, is_rnn, device, seq_len)
         self._idx_buf = torch.randperm(batch_size)
+
+        # in contiguous mode the whole batch is permuted once per mini-epoch into reused
+        # buffers, and each minibatch is a slice of them instead of a gather
+        self._contiguous = contiguous
+        self._shuffled_dict = dict()
+        self._shuffled = False
         return
     
     def update_mu_sigma(self, mu, sigma):	  
         raise NotImplementedError()
         return
 
+    def update_values_dict(self, values_dict):
+        super().update_values_dict(values_dict)
+        self._shuffled = False
+        return
+
     def _get_item(self, idx):
+        if self._contiguous:
+            return self._get_contiguous_item(idx)
+
         start = idx * self.minibatch_size
         end = (idx + 1) * self.minibatch_size
         sample_idx = self._idx_buf[start:end]
@@ -55,6 +69,39 @@ class AMPDataset(datasets.PPODataset):
 
         return input_dict
 
+    def _get_contiguous_item(self, idx):
+        if not self._shuffled:
+            self._shuffle_values()
+
+        start = idx * self.minibatch_size
+        end = (idx + 1) * self.minibatch_size
+
+        input_dict = {}
+        for k, v in self._shuffled_dict.items():
+            input_dict[k] = v[start:end]
+
+        if end >= self.batch_size:
+            self._shuffle_idx_buf()
+            self._shuffled = False
+
+        return input_dict
+
+    def _shuffle_values(self):
+        idx_buf = self._idx_buf.to(self.device)
+        shuffled_dict = dict()
+
+        for k, v in self.values_dict.items():
+            if k not in self.special_names and v is not None:
+                buf = self._shuffled_dict.get(k, None)
+                if buf is None or buf.shape != v.shape or buf.dtype != v.dtype or buf.device != v.device:
+                    buf = torch.empty_like(v)
+                torch.index_select(v, 0, idx_buf, out=buf)
+                shuffled_dict[k] = buf
+
+        self._shuffled_dict = shuffled_dict
+        self._shuffled = True
+        return
+
     def _shuffle_idx_buf(self):
         self._idx_buf[:] = torch.randperm(self.batch_size)
         return
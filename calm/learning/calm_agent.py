@@ -27,6 +27,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from learning import amp_agent 
+from learning import demo_producer
 
 import torch
 
@@ -51,12 +52,18 @@ class CALMAgent(amp_agent.AMPAgent):
         
         batch_shape = self.experience_buffer.obs_base_shape
         self.experience_buffer.tensor_dict['calm_latents'] = torch.zeros(batch_shape + (self._latent_dim,), dtype=torch.float32, device=self.ppo_device)
-        self.experience_buffer.tensor_dict['enc_amp_obs'] = torch.zeros(batch_shape + self._enc_amp_observation_space.shape, dtype=torch.float32, device=self.ppo_device)
+        self.experience_buffer.tensor_dict['enc_amp_obs_ids'] = torch.zeros(batch_shape, dtype=torch.long, device=self.ppo_device)
         
         self._calm_latents = torch.zeros((batch_shape[-1], self._latent_dim), dtype=torch.float32, device=self.ppo_device)
         self._enc_amp_obs = torch.zeros((batch_shape[-1], self._enc_amp_observation_space.shape[-1]), dtype=torch.float32, device=self.ppo_device)
+
+        # the encoder window of an env only changes when its latent is reset, so the rollout stores
+        # an index into a table holding each window of the epoch once
+        self._enc_amp_obs_ids = torch.arange(batch_shape[-1], dtype=torch.long, device=self.ppo_device)
+        self._enc_amp_obs_table = torch.zeros((2 * batch_shape[-1], self._enc_amp_observation_space.shape[-1]), dtype=self._amp_obs_storage_dtype, device=self.ppo_device)
+        self._enc_amp_obs_table_count = 0
         
-        self.tensor_list += ['calm_latents', 'enc_amp_obs']
+        self.tensor_list += ['calm_latents', 'enc_amp_obs_ids']
 
         self._latent_reset_steps = torch.zeros(batch_shape[-1], dtype=torch.int32, device=self.ppo_device)
         num_envs = self.vec_env.env.task.num_envs
@@ -67,12 +74,17 @@ class CALMAgent(amp_agent.AMPAgent):
 
     def play_steps(self):
         self.set_eval()
+        self._reset_enc_amp_obs_table()
+        self._refresh_latent_pool()
         
         epinfos = []
         done_indices = []
         update_list = self.update_list
 
         for n in range(self.horizon_length):
+            if self._compiled_policy_step is not None and self._compiled_cuda_graphs:
+                torch.compiler.cudagraph_mark_step_begin()
+
             self.obs = self.env_reset(done_indices)
             self.experience_buffer.update_data('obses', n, self.obs['obs'])
 
@@ -97,13 +109,13 @@ class CALMAgent(amp_agent.AMPAgent):
             self.experience_buffer.update_data('dones', n, self.dones)
             self.experience_buffer.update_data('amp_obs', n, infos['amp_obs'])
             self.experience_buffer.update_data('calm_latents', n, self._calm_latents)
-            self.experience_buffer.update_data('enc_amp_obs', n, self._enc_amp_obs)
+            self.experience_buffer.update_data('enc_amp_obs_ids', n, self._enc_amp_obs_ids)
             self.experience_buffer.update_data('rand_action_mask', n, res_dict['rand_action_mask'])
 
-            terminated = infos['terminate'].float()
-            terminated = terminated.unsqueeze(-1)
-            next_vals = self._eval_critic(self.obs, self._calm_latents)
-            next_vals *= (1.0 - terminated)
+            if self._compiled_next_values_step is not None:
+                next_vals = self._compiled_next_values_step(self.obs['obs'], self._calm_latents, infos['terminate'])
+            else:
+                next_vals = self._eval_next_values(self.obs['obs'], self._calm_latents, infos['terminate'])
             self.experience_buffer.update_data('next_values', n, next_vals)
 
             self.current_rewards += rewards
@@ -148,6 +160,12 @@ class CALMAgent(amp_agent.AMPAgent):
         return batch_dict
 
     def get_action_values(self, obs_dict, calm_latents, rand_action_probs):
+        if self._compiled_policy_step is not None:
+            self.model.eval()
+            with torch.no_grad():
+                res_dict = self._compiled_policy_step(obs_dict['obs'], calm_latents, rand_action_probs)
+            return res_dict
+
         processed_obs = self._preproc_obs(obs_dict['obs'])
 
         self.model.eval()
@@ -173,17 +191,71 @@ class CALMAgent(amp_agent.AMPAgent):
         if self.normalize_value:
             res_dict['values'] = self.value_mean_std(res_dict['values'], True)
         
+        self._apply_rand_action_mask(res_dict, rand_action_probs)
+
+        return res_dict
+
+    def _eval_policy_step(self, obs, calm_latents, rand_action_probs):
+        # get_action_values without the central value and rnn paths, written so that torch.compile can capture it whole
+        processed_obs = self._preproc_obs(obs)
+        input_dict = {
+            'is_train': False,
+            'prev_actions': None, 
+            'obs': processed_obs,
+            'rnn_states': None,
+            'calm_latents': calm_latents
+        }
+        res_dict = self.model(input_dict)
+
+        if self.normalize_value:
+            res_dict['values'] = self.value_mean_std(res_dict['values'], True)
+
+        self._apply_rand_action_mask(res_dict, rand_action_probs)
+        return res_dict
+
+    def _apply_rand_action_mask(self, res_dict, rand_action_probs):
+        # deterministic envs take the mean action, selected with a where instead of a masked assignment
+        # so that the number of masked envs never has to be known on the host
         rand_action_mask = torch.bernoulli(rand_action_probs)
         det_action_mask = rand_action_mask == 0.0
-        res_dict['actions'][det_action_mask] = res_dict['mus'][det_action_mask]
+        res_dict['actions'] = torch.where(det_action_mask.unsqueeze(-1), res_dict['mus'], res_dict['actions'])
         res_dict['rand_action_mask'] = rand_action_mask
+        return
 
-        return res_dict
+    def _eval_next_values(self, obs, calm_latents, terminate):
+        # _eval_critic for the next observations, zeroed for terminated envs
+        processed_obs = self._preproc_obs(obs)
+        next_vals = self.model.a2c_network.eval_critic(processed_obs, calm_latents)
+        if self.normalize_value:
+            next_vals = self.value_mean_std(next_vals, True)
+
+        terminated = terminate.float().unsqueeze(-1)
+        next_vals = next_vals * (1.0 - terminated)
+        return next_vals
+
+    def _build_compiled_rollout(self):
+        if not self._compile_rollout:
+            return
+
+        assert(not self.is_rnn and not self.has_central_value and not self.use_action_masks), \
+            "compile_rollout only supports feed forward policies without a central value or action masks"
+
+        if not hasattr(torch, "compile"):
+            print("compile_rollout needs torch.compile, which torch {:s} does not have. Running the rollout eagerly".format(torch.__version__))
+            return
+
+        # on the gpu the captured steps are replayed as cuda graphs, which needs the step markers of torch.compiler
+        self._compiled_cuda_graphs = torch.device(self.ppo_device).type == "cuda" \
+                                     and hasattr(getattr(torch, "compiler", None), "cudagraph_mark_step_begin")
+        mode = "reduce-overhead" if self._compiled_cuda_graphs else "default"
+        self._compiled_policy_step = torch.compile(self._eval_policy_step, mode=mode, dynamic=False)
+        self._compiled_next_values_step = torch.compile(self._eval_next_values, mode=mode, dynamic=False)
+        return
 
     def prepare_dataset(self, batch_dict):
         super().prepare_dataset(batch_dict)
 
-        self.dataset.values_dict['enc_amp_obs'] = batch_dict['enc_amp_obs']
+        self.dataset.values_dict['enc_amp_obs_ids'] = batch_dict['enc_amp_obs_ids']
         self.dataset.values_dict['enc_amp_obs_replay'] = batch_dict['enc_amp_obs_replay']
         self.dataset.values_dict['enc_amp_obs_demo'] = batch_dict['enc_amp_obs_demo']
 
@@ -192,29 +264,43 @@ class CALMAgent(amp_agent.AMPAgent):
     def train_epoch(self):
         play_time_start = time.time()
 
+        # the demo producer shares the motion library with the env, so it only runs outside of rollouts
+        if self._demo_producer is not None:
+            self._demo_producer.pause()
+
         with torch.no_grad():
             if self.is_rnn:
                 batch_dict = self.play_steps_rnn()
             else:
                 batch_dict = self.play_steps()
 
+        # the enc_reg pool is fetched on this thread, so it is filled before the producer runs again
+        if self._enc_reg_coeff > 0 and self._enc_reg_pool_size > 0:
+            self._update_enc_reg_pool()
+
+        if self._demo_producer is not None:
+            self._demo_producer.resume()
+
         play_time_end = time.time()
         update_time_start = time.time()
         rnn_masks = batch_dict.get('rnn_masks', None)
 
         self._update_amp_demos()
+
         num_obs_samples = batch_dict['amp_obs'].shape[0]
-        samples = self._amp_obs_demo_buffer.sample(num_obs_samples)
+        # the sampled views are only used by this epoch's update, before the buffers are sampled again
+        samples = self._amp_obs_demo_buffer.sample(num_obs_samples, copy=False)
         batch_dict['amp_obs_demo'] = samples['amp_obs']
         batch_dict['enc_amp_obs_demo'] = samples['enc_amp_obs']
 
         if self._amp_replay_buffer.get_total_count() == 0:
             batch_dict['amp_obs_replay'] = batch_dict['amp_obs']
-            batch_dict['enc_amp_obs_replay'] = batch_dict['enc_amp_obs']
+            batch_dict['enc_amp_obs_replay'] = self._enc_amp_obs_table[batch_dict['enc_amp_obs_ids']]
         else:
-            samples = self._amp_replay_buffer.sample(num_obs_samples)
+            samples = self._amp_replay_buffer.sample(num_obs_samples, copy=False)
             batch_dict['amp_obs_replay'] = samples['amp_obs']
             batch_dict['enc_amp_obs_replay'] = samples['enc_amp_obs']
+            batch_dict['amp_obs_replay_idx'] = samples.get('idx', None)
 
         self.set_train()
 
@@ -273,7 +359,7 @@ class CALMAgent(amp_agent.AMPAgent):
         update_time = update_time_end - update_time_start
         total_time = update_time_end - play_time_start
 
-        self._store_replay_amp_obs(batch_dict['amp_obs'], batch_dict['enc_amp_obs'])
+        self._store_replay_amp_obs(batch_dict['amp_obs'], batch_dict['enc_amp_obs_ids'])
 
         train_info['play_time'] = play_time
         train_info['update_time'] = update_time
@@ -295,7 +381,8 @@ class CALMAgent(amp_agent.AMPAgent):
         obs_batch = input_dict['obs']
         obs_batch = self._preproc_obs(obs_batch)
 
-        enc_amp_obs = self._preproc_amp_obs(input_dict['enc_amp_obs'])
+        enc_amp_obs = self._enc_amp_obs_table[input_dict['enc_amp_obs_ids']]
+        enc_amp_obs = self._preproc_amp_obs(enc_amp_obs)
 
         mb_enc_amp_obs_demo = input_dict['enc_amp_obs_demo'][0:self._amp_minibatch_size]
         mb_enc_amp_obs_demo = self._preproc_amp_obs(mb_enc_amp_obs_demo)
@@ -310,21 +397,25 @@ class CALMAgent(amp_agent.AMPAgent):
         mb_amp_obs_demo = self._preproc_amp_obs(mb_amp_obs_demo)
         mb_amp_obs_demo.requires_grad_(True)
 
+        mb_enc_amp_obs_replay = input_dict['enc_amp_obs_replay'][0:self._amp_minibatch_size]
+        mb_enc_amp_obs_replay = self._preproc_amp_obs(mb_enc_amp_obs_replay)
+
+        enc_inputs = [enc_amp_obs]
+        if self._enc_reg_coeff > 0:
+            enc_inputs += [self._preproc_amp_obs(x) for x in self._get_enc_reg_demos()]
+
+        # all encoder inputs that need gradients go through one forward pass, and those that don't through another
         with torch.no_grad():
-            mb_calm_latents_demo = self._eval_enc(mb_enc_amp_obs_demo)
+            mb_calm_latents_demo, mb_calm_latents_replay = self._eval_enc_batched([mb_enc_amp_obs_demo, mb_enc_amp_obs_replay])
         mb_calm_latents_demo.requires_grad_(True)
 
         # Update relevant latents with output from enc to drive gradients backward from policy to the encoder.
-        amp_obs_encoding = self._eval_enc(enc_amp_obs)
+        enc_outputs = self._eval_enc_batched(enc_inputs)
+        amp_obs_encoding = enc_outputs[0]
         calm_latents = amp_obs_encoding
 
         mb_calm_latents = calm_latents[0:self._amp_minibatch_size]
 
-        mb_enc_amp_obs_replay = input_dict['enc_amp_obs_replay'][0:self._amp_minibatch_size]
-        mb_enc_amp_obs_replay = self._preproc_amp_obs(mb_enc_amp_obs_replay)
-        with torch.no_grad():
-            mb_calm_latents_replay = self._eval_enc(mb_enc_amp_obs_replay)
-
         rand_action_mask = input_dict['rand_action_mask']
         rand_action_sum = torch.sum(rand_action_mask)
 
@@ -400,7 +491,7 @@ class CALMAgent(amp_agent.AMPAgent):
             if self._enc_reg_coeff <= 0:
                 enc_reg_loss = 0
             else:
-                enc_reg_info = self._enc_reg_loss()
+                enc_reg_info = self._enc_reg_loss(*enc_outputs[1:])
                 enc_reg_loss = enc_reg_info['enc_reg_loss']
 
             # Regularization for the discriminator
@@ -412,6 +503,8 @@ class CALMAgent(amp_agent.AMPAgent):
             conditional_disc_info = self._conditional_disc_loss(conditional_disc_agent_cat_logit, conditional_disc_demo_logit, mb_amp_obs_demo, mb_calm_latents_demo)
             conditional_disc_loss = conditional_disc_info['conditional_disc_loss']
 
+            self._update_amp_replay_priorities(input_dict, conditional_disc_agent_replay_logit)
+
             loss = a_loss + self.critic_coef * c_loss - self.entropy_coef * entropy + self.bounds_loss_coef * b_loss \
                    + self._disc_coef * disc_loss + self._conditional_disc_coef * conditional_disc_loss + self._enc_reg_coeff * enc_reg_loss
 
@@ -506,23 +599,19 @@ class CALMAgent(amp_agent.AMPAgent):
         }
         return disc_info
 
-    def _enc_reg_loss(self):
-        enc_amp_obs_demo, _ = self._fetch_amp_obs_demo(self._amp_minibatch_size)
-        proc_enc_amp_obs_demo = self._preproc_amp_obs(enc_amp_obs_demo)
-
-        amp_obs_encoding = self._eval_enc(proc_enc_amp_obs_demo)
+    def _get_enc_reg_demos(self):
+        if self._enc_reg_pool is not None:
+            enc_reg_demos = self._next_enc_reg_pool_demos()
+        elif self._demo_producer is not None:
+            enc_reg_demos = self._demo_producer.get('enc_reg')
+        else:
+            enc_reg_demos = self._fetch_enc_reg_demos(self._amp_minibatch_size)
+        return enc_reg_demos
 
+    def _enc_reg_loss(self, amp_obs_encoding, similar_amp_obs_encoding0, similar_amp_obs_encoding1):
         # Loss for uniform distribution over the sphere
         uniform_l = uniform_loss(amp_obs_encoding)
 
-        _, _, similar_enc_amp_obs_demo0, _, similar_enc_amp_obs_demo1 = self.vec_env.env.task.fetch_amp_obs_demo_pair(self._amp_minibatch_size)
-
-        proc_similar_enc_amp_obs_demo0 = self._preproc_amp_obs(similar_enc_amp_obs_demo0)
-        proc_similar_enc_amp_obs_demo1 = self._preproc_amp_obs(similar_enc_amp_obs_demo1)
-
-        similar_amp_obs_encoding0 = self._eval_enc(proc_similar_enc_amp_obs_demo0)
-        similar_amp_obs_encoding1 = self._eval_enc(proc_similar_enc_amp_obs_demo1)
-
         # Loss for alignment - overlapping motions should have 'close' embeddings
         align_l = align_loss(similar_amp_obs_encoding0, similar_amp_obs_encoding1)
 
@@ -530,6 +619,24 @@ class CALMAgent(amp_agent.AMPAgent):
 
         return {'enc_reg_loss': loss}
 
+    def _fetch_enc_reg_demos(self, num_samples):
+        enc_amp_obs_demo, _ = self._fetch_amp_obs_demo(num_samples)
+        _, _, similar_enc_amp_obs_demo0, _, similar_enc_amp_obs_demo1 = self.vec_env.env.task.fetch_amp_obs_demo_pair(num_samples)
+        return enc_amp_obs_demo, similar_enc_amp_obs_demo0, similar_enc_amp_obs_demo1
+
+    def _update_enc_reg_pool(self):
+        # one fetch per epoch for the demos of enc_reg_pool_size minibatches, which are then handed out in turn
+        num_samples = self._enc_reg_pool_size * self._amp_minibatch_size
+        self._enc_reg_pool = self._fetch_enc_reg_demos(num_samples)
+        self._enc_reg_pool_head = 0
+        return
+
+    def _next_enc_reg_pool_demos(self):
+        start = (self._enc_reg_pool_head % self._enc_reg_pool_size) * self._amp_minibatch_size
+        end = start + self._amp_minibatch_size
+        self._enc_reg_pool_head += 1
+        return tuple([x[start:end] for x in self._enc_reg_pool])
+
     def env_reset(self, env_ids=None):
         obs = super().env_reset(env_ids)
         
@@ -568,6 +675,26 @@ class CALMAgent(amp_agent.AMPAgent):
 
         self._enc_reg_coeff = config.get('enc_regularization_coeff', 0)
 
+        # number of encoded demo latents sampled once per epoch, expired latents are replaced with pool entries
+        # without syncing with the host, 0 encodes fresh demos for the expired envs on every step
+        self._latent_pool_size = config.get('latent_pool_size', 0)
+        self._latent_pool = None
+
+        # play_steps evaluates the policy and the next values with torch.compile captured functions
+        self._compile_rollout = config.get('compile_rollout', False)
+        self._compiled_cuda_graphs = False
+        self._compiled_policy_step = None
+        self._compiled_next_values_step = None
+
+        # number of minibatches of enc regularization demos fetched together at the start of each epoch,
+        # 0 fetches fresh demos for every minibatch
+        self._enc_reg_pool_size = config.get('enc_reg_pool_size', 0)
+        self._enc_reg_pool = None
+
+        # number of demo batches of each kind kept ready by a background producer, 0 fetches them inline
+        self._demo_producer_queue_size = config.get('demo_producer_queue_size', 0)
+        self._demo_producer = None
+
         self._enc_amp_observation_space = self.env_info['enc_amp_observation_space']
 
         if not hasattr(self, 'vec_env'):
@@ -585,12 +712,65 @@ class CALMAgent(amp_agent.AMPAgent):
         z, enc_amp_obs_demo = self._sample_latents(n)
         self._calm_latents[env_ids] = z
         self._enc_amp_obs[env_ids] = enc_amp_obs_demo
+        self._append_enc_amp_obs(env_ids, enc_amp_obs_demo)
 
         if self.vec_env.env.task.viewer:
             self._change_char_color(env_ids)
 
         return
 
+    def _reset_enc_amp_obs_table(self):
+        self._gather_latent_pool_enc_amp_obs()
+
+        num_envs = self._enc_amp_obs.shape[0]
+        self._enc_amp_obs_table[:num_envs] = self._enc_amp_obs
+        self._enc_amp_obs_ids[:] = torch.arange(num_envs, dtype=torch.long, device=self.ppo_device)
+        self._enc_amp_obs_table_count = num_envs
+        return
+
+    def _append_enc_amp_obs(self, env_ids, enc_amp_obs):
+        start, end = self._extend_enc_amp_obs_table(enc_amp_obs)
+        self._enc_amp_obs_ids[env_ids] = torch.arange(start, end, dtype=torch.long, device=self.ppo_device)
+        return
+
+    def _extend_enc_amp_obs_table(self, enc_amp_obs):
+        n = enc_amp_obs.shape[0]
+        start = self._enc_amp_obs_table_count
+        end = start + n
+
+        table_size = self._enc_amp_obs_table.shape[0]
+        if end > table_size:
+            new_table = torch.zeros((max(2 * table_size, end),) + self._enc_amp_obs_table.shape[1:],
+                                    dtype=self._enc_amp_obs_table.dtype, device=self.ppo_device)
+            new_table[:start] = self._enc_amp_obs_table[:start]
+            self._enc_amp_obs_table = new_table
+
+        self._enc_amp_obs_table[start:end] = enc_amp_obs
+        self._enc_amp_obs_table_count = end
+        return start, end
+
+    def _refresh_latent_pool(self):
+        if self._latent_pool_size <= 0:
+            return
+
+        # the pool windows are written to the window table once, so the ids of pooled latents
+        # stay valid for the whole epoch
+        self._latent_pool, self._latent_pool_enc_amp_obs = self._sample_latents(self._latent_pool_size)
+        start, end = self._extend_enc_amp_obs_table(self._latent_pool_enc_amp_obs)
+        self._latent_pool_ids = torch.arange(start, end, dtype=torch.long, device=self.ppo_device)
+        return
+
+    def _gather_latent_pool_enc_amp_obs(self):
+        if self._latent_pool is None:
+            return
+
+        pool_start = self._latent_pool_ids[0]
+        pool_end = pool_start + self._latent_pool_size
+        from_pool = torch.logical_and(self._enc_amp_obs_ids >= pool_start, self._enc_amp_obs_ids < pool_end)
+        pool_idx = torch.clamp(self._enc_amp_obs_ids - pool_start, 0, self._latent_pool_size - 1)
+        self._enc_amp_obs[:] = torch.where(from_pool.unsqueeze(-1), self._latent_pool_enc_amp_obs[pool_idx], self._enc_amp_obs)
+        return
+
     def _sample_latents(self, n):
         enc_amp_obs_demo, _ = self._fetch_amp_obs_demo(n)
         with torch.no_grad():
@@ -600,6 +780,10 @@ class CALMAgent(amp_agent.AMPAgent):
         return latents, enc_amp_obs_demo
 
     def _update_latents(self):
+        if self._latent_pool_size > 0:
+            self._update_latents_from_pool()
+            return
+
         new_latent_envs = self._latent_reset_steps <= self.vec_env.env.task.progress_buf
 
         need_update = torch.any(new_latent_envs)
@@ -614,14 +798,44 @@ class CALMAgent(amp_agent.AMPAgent):
 
         return
 
+    def _update_latents_from_pool(self):
+        # every env draws a pool entry and only the expired ones take it, so all shapes are fixed
+        # and the set of expired envs never has to be read back on the host,
+        # _enc_amp_obs of the swapped envs is only gathered from the pool at the end of the epoch
+        new_latent_envs = self._latent_reset_steps <= self.vec_env.env.task.progress_buf
+        num_envs = new_latent_envs.shape[0]
+        pool_idx = torch.randint(0, self._latent_pool_size, (num_envs,), device=self.ppo_device)
+
+        self._calm_latents[:] = torch.where(new_latent_envs.unsqueeze(-1), self._latent_pool[pool_idx], self._calm_latents)
+        self._enc_amp_obs_ids[:] = torch.where(new_latent_envs, self._latent_pool_ids[pool_idx], self._enc_amp_obs_ids)
+
+        latent_steps = torch.randint_like(self._latent_reset_steps, low=self._latent_steps_min, high=self._latent_steps_max)
+        self._latent_reset_steps += torch.where(new_latent_envs, latent_steps, torch.zeros_like(latent_steps))
+
+        if self.vec_env.env.task.viewer:
+            new_latent_env_ids = new_latent_envs.nonzero(as_tuple=False).flatten()
+            if len(new_latent_env_ids) > 0:
+                self._change_char_color(new_latent_env_ids)
+
+        return
+
     def _eval_actor(self, obs, calm_latents):
         output = self.model.a2c_network.eval_actor(obs=obs, calm_latents=calm_latents)
         return output
 
+    def encode_amp_obs_demo(self, enc_amp_obs):
+        return self._eval_enc(self._preproc_amp_obs(enc_amp_obs))
+
     def _eval_enc(self, amp_obs):
         output = self.model.a2c_network.eval_enc(amp_obs=amp_obs)
         return output
 
+    def _eval_enc_batched(self, amp_obs_list):
+        # the encoder is applied row by row, so concatenating the inputs gives the same encodings in one pass
+        sizes = [amp_obs.shape[0] for amp_obs in amp_obs_list]
+        output = self._eval_enc(torch.cat(amp_obs_list, dim=0))
+        return torch.split(output, sizes, dim=0)
+
     def _eval_critic(self, obs_dict, calm_latents):
         self.model.eval()
         obs = obs_dict['obs']
@@ -670,7 +884,7 @@ class CALMAgent(amp_agent.AMPAgent):
         train_info['conditional_disc_rewards'] = batch_dict['conditional_disc_rewards']
         return
 
-    def _store_replay_amp_obs(self, amp_obs, enc_amp_obs):
+    def _store_replay_amp_obs(self, amp_obs, enc_amp_obs_ids):
         if amp_obs.shape[0] > 0:
             buf_size = self._amp_replay_buffer.get_buffer_size()
             buf_total_count = self._amp_replay_buffer.get_total_count()
@@ -678,14 +892,15 @@ class CALMAgent(amp_agent.AMPAgent):
                 keep_probs = to_torch(np.array([self._amp_replay_keep_prob] * amp_obs.shape[0]), device=self.ppo_device)
                 keep_mask = torch.bernoulli(keep_probs) == 1.0
                 amp_obs = amp_obs[keep_mask]
-                enc_amp_obs = enc_amp_obs[keep_mask]
+                enc_amp_obs_ids = enc_amp_obs_ids[keep_mask]
 
             if (amp_obs.shape[0] > buf_size):
                 rand_idx = torch.randperm(amp_obs.shape[0])
                 rand_idx = rand_idx[:buf_size]
                 amp_obs = amp_obs[rand_idx]
-                enc_amp_obs = enc_amp_obs[rand_idx]
+                enc_amp_obs_ids = enc_amp_obs_ids[rand_idx]
 
+            enc_amp_obs = self._enc_amp_obs_table[enc_amp_obs_ids]
             self._amp_replay_buffer.store({'amp_obs': amp_obs, 'enc_amp_obs': enc_amp_obs})
         return
 
@@ -740,6 +955,12 @@ class CALMAgent(amp_agent.AMPAgent):
         _, _, enc_amp_obs_demo_flat, _, amp_obs_demo_flat = self.vec_env.env.fetch_amp_obs_demo_enc_pair(num_samples)
         return enc_amp_obs_demo_flat, amp_obs_demo_flat
 
+    def _get_amp_obs_keys(self):
+        return ['amp_obs', 'enc_amp_obs_ids']
+
+    def _get_amp_replay_row_numel(self):
+        return super()._get_amp_replay_row_numel() + self._enc_amp_observation_space.shape[-1]
+
     def _init_amp_demo_buf(self):
         buffer_size = self._amp_obs_demo_buffer.get_buffer_size()
         num_batches = int(np.ceil(buffer_size / self._amp_batch_size))
@@ -750,8 +971,30 @@ class CALMAgent(amp_agent.AMPAgent):
 
         return
 
+    def _init_train(self):
+        super()._init_train()
+        self._build_demo_producer()
+        self._build_compiled_rollout()
+        return
+
+    def _build_demo_producer(self):
+        if self._demo_producer_queue_size <= 0:
+            return
+
+        producers = {
+            'amp_obs_demo': lambda: self._fetch_amp_obs_demo(self._amp_batch_size)
+        }
+        if self._enc_reg_coeff > 0 and self._enc_reg_pool_size <= 0:
+            producers['enc_reg'] = lambda: self._fetch_enc_reg_demos(self._amp_minibatch_size)
+
+        self._demo_producer = demo_producer.DemoProducer(producers, self._demo_producer_queue_size, self.ppo_device)
+        return
+
     def _update_amp_demos(self):
-        enc_amp_obs_demo, amp_obs_demo = self._fetch_amp_obs_demo(self._amp_batch_size)
+        if self._demo_producer is not None:
+            enc_amp_obs_demo, amp_obs_demo = self._demo_producer.get('amp_obs_demo')
+        else:
+            enc_amp_obs_demo, amp_obs_demo = self._fetch_amp_obs_demo(self._amp_batch_size)
         self._amp_obs_demo_buffer.store({'amp_obs': amp_obs_demo, 'enc_amp_obs': enc_amp_obs_demo})
         return
 
@@ -48,6 +48,16 @@ class CALMPlayer(amp_players.AMPPlayerContinuous):
         self._conditional_disc_reward_scale = config['conditional_disc_reward_scale']
         self._amp_batch_size = int(config['amp_batch_size'])
 
+        # expired data latents are handed out from a pool without replacement, the pool is renewed once used up
+        self._latent_pool_size = config.get('latent_pool_size', 0)
+        if self._latent_pool_size <= 0:
+            self._latent_pool_size = self._amp_batch_size
+        self._latent_pool = None
+        self._latent_pool_head = 0
+
+        # no latent countdown can run out in fewer steps than this, those steps skip the latent update
+        self._latent_steps_to_expiry = 0
+
         if 'env' in config:
             self.env = config['env']
 
@@ -58,6 +68,8 @@ class CALMPlayer(amp_players.AMPPlayerContinuous):
         else:
             batch_size = self.env_info['num_envs']
         self._calm_latents = torch.zeros((batch_size, self._latent_dim), dtype=torch.float32, device=self.device)
+        self._latent_step_count = torch.zeros(batch_size, dtype=torch.int32, device=self.device)
+        self._latent_pool_size = max(self._latent_pool_size, batch_size)
 
         if self._interpolate_latents is True:
             self._latents0 = torch.zeros((batch_size, self._latent_dim), dtype=torch.float32, device=self.device)
@@ -78,7 +90,7 @@ class CALMPlayer(amp_players.AMPPlayerContinuous):
         return
 
     def _fetch_amp_obs_demo(self, num_samples):
-        motion_ids, _, enc_amp_obs_demo_flat, _, _ = self.env.fetch_amp_obs_demo_enc_pair(num_samples)
+        motion_ids, _, enc_amp_obs_demo_flat = self.env.fetch_amp_obs_demo_enc(num_samples)
         return motion_ids, enc_amp_obs_demo_flat
 
     def get_action(self, obs_dict, is_determenistic=False):
@@ -147,6 +159,8 @@ class CALMPlayer(amp_players.AMPPlayerContinuous):
                 self._interpolation_alpha[done_env_ids] = 1.
 
             self._calm_latents[done_env_ids] = z
+            if not self._sample_latent_only_on_reset:
+                self._reset_latent_step_count(done_env_ids)
             self._change_char_color(done_env_ids)
 
         return
@@ -157,48 +171,108 @@ class CALMPlayer(amp_players.AMPPlayerContinuous):
         # 3. encode
 
         motion_ids, new_enc_amp_obs_demo = self._fetch_amp_obs_demo(n)
+        encoded_demo_amp_obs = self.encode_amp_obs_demo(new_enc_amp_obs_demo)
 
-        proc_new_enc_amp_obs = self._preproc_amp_obs(new_enc_amp_obs_demo)
-        with torch.no_grad():
-            encoded_demo_amp_obs = self.model.a2c_network.eval_enc(proc_new_enc_amp_obs)
-
-        # if we're interpolating from data, let's make it visually appealing by forcing the main character to have
+        # if we're interpolating from data, let's make it visually appealing by forcing every character to have
         # two different motion files to interpolate from.
-        motion_indices = motion_ids
-        if self._interpolate_latents and motion_ids[0].item() == motion_ids[n // 2].item():
-            for idx in range(1, n):
-                if motion_ids[idx].item() != motion_ids[0].item():
-                    encoded_demo_amp_obs[n // 2] = encoded_demo_amp_obs[idx]
-                    break
+        if self._interpolate_latents:
+            encoded_demo_amp_obs, motion_ids = self._make_distinct_latent_pairs(encoded_demo_amp_obs, motion_ids)
+
+        return encoded_demo_amp_obs, motion_ids
 
-        return encoded_demo_amp_obs, motion_indices
+    def _make_distinct_latent_pairs(self, latents, motion_ids):
+        # latent i of the first half is paired with latent i of the second half, a pair drawn from a single clip
+        # takes the first latent of the batch that comes from another clip instead, if there is one.
+        # that is latent 0, unless the pair is from the clip of latent 0, then it is the first latent from any other clip
+        half = motion_ids.shape[0] // 2
+        pair_ids = torch.arange(half, 2 * half, dtype=torch.long, device=motion_ids.device)
+        not_first_clip = motion_ids != motion_ids[0]
+        first_other_idx = torch.argmax(not_first_clip.int())
+        other_idx = torch.where(not_first_clip[:half], torch.zeros_like(pair_ids), first_other_idx)
+
+        replace = torch.logical_and(motion_ids[:half] == motion_ids[half:2 * half], torch.any(not_first_clip))
+        pair_ids = torch.where(replace, other_idx, pair_ids)
+
+        latents = torch.cat([latents[:half], latents[pair_ids], latents[2 * half:]], dim=0)
+        motion_ids = torch.cat([motion_ids[:half], motion_ids[pair_ids], motion_ids[2 * half:]], dim=0)
+        return latents, motion_ids
+
+    def encode_amp_obs_demo(self, enc_amp_obs):
+        proc_enc_amp_obs = self._preproc_amp_obs(enc_amp_obs)
+        with torch.no_grad():
+            encoded_demo_amp_obs = self.model.a2c_network.eval_enc(proc_enc_amp_obs)
+        return encoded_demo_amp_obs
 
     def _update_latents(self):
-        if self._latent_step_count <= 0:
+        # every env counts down on its own. the host keeps a lower bound on the steps left until the first
+        # countdown runs out, so the steps before that only count down and read nothing back
+        if self._latent_steps_to_expiry > 0:
+            self._latent_step_count -= 1
+            self._latent_steps_to_expiry -= 1
+            return
+
+        expired = self._latent_step_count <= 0
+        expired_env_ids = expired.nonzero(as_tuple=False).flatten()
+        num_expired = len(expired_env_ids)
+
+        self._latent_step_count -= 1
+        if num_expired > 0:
             if self._interpolate_latents:
-                self._interpolation_alpha -= 1. / self._interpolation_steps
+                self._interpolation_alpha[expired_env_ids] -= 1. / self._interpolation_steps
 
-                clamped_alpha = torch.clamp_min(self._interpolation_alpha, min=0)
-                self._calm_latents = torch.nn.functional.normalize(self._latents0 * clamped_alpha + self._latents1 * (1 - clamped_alpha), dim=1)
+                clamped_alpha = torch.clamp_min(self._interpolation_alpha[expired_env_ids], min=0)
+                self._calm_latents[expired_env_ids] = torch.nn.functional.normalize(torch.lerp(self._latents1[expired_env_ids],
+                                                                                               self._latents0[expired_env_ids],
+                                                                                               clamped_alpha), dim=1)
             else:
-                self._reset_latents()
-            self._reset_latent_step_count()
-
-            if self.env.task.viewer:
-                print("Sampling new calm latents------------------------------")
-                num_envs = self.env.task.num_envs
-                env_ids = to_torch(np.arange(num_envs), dtype=torch.long, device=self.device)
-                self._change_char_color(env_ids)
+                self._calm_latents[expired_env_ids] = self._draw_latents(num_expired)
+            self._latent_step_count[expired_env_ids] = self._sample_latent_step_count(num_expired)
+
+        self._latent_steps_to_expiry = int(torch.min(self._latent_step_count))
+
+        if self.env.task.viewer and num_expired > 0:
+            print("Sampling new calm latents------------------------------")
+            self._change_char_color(expired_env_ids)
+        return
+
+    def _draw_latents(self, n):
+        if not self._get_latents_from_data:
+            z = torch.normal(torch.zeros([n, self._latent_dim], device=self.device))
+            return torch.nn.functional.normalize(z, dim=-1)
+
+        # the pool holds at least one latent per env and is handed out in order, so the envs that expire
+        # together never share a latent
+        if self._latent_pool is None or self._latent_pool_head + n > self._latent_pool.shape[0]:
+            z, _ = self._sample_latents(self._latent_pool_size)
+            self._latent_pool = torch.nn.functional.normalize(z, dim=-1)
+            self._latent_pool_head = 0
+
+        z = self._latent_pool[self._latent_pool_head:(self._latent_pool_head + n)]
+        self._latent_pool_head += n
+        return z
+
+    def _reset_latent_step_count(self, env_ids=None):
+        if env_ids is None:
+            self._latent_step_count[:] = self._sample_latent_step_count(self._latent_step_count.shape[0])
+            self._latent_steps_to_expiry = 0
         else:
-            self._latent_step_count -= 1
+            self._latent_step_count[env_ids] = self._sample_latent_step_count(len(env_ids))
+            self._latent_steps_to_expiry = min(self._latent_steps_to_expiry, self._get_min_latent_step_count())
         return
 
-    def _reset_latent_step_count(self):
+    def _get_min_latent_step_count(self):
         if self._interpolate_latents:
-            self._latent_step_count = self.env.task.max_episode_length // self._interpolation_steps
+            return self.env.task.max_episode_length // self._interpolation_steps
+        return self._latent_steps_min
+
+    def _sample_latent_step_count(self, n):
+        if self._interpolate_latents:
+            latent_step_count = torch.full((n,), self.env.task.max_episode_length // self._interpolation_steps,
+                                           dtype=torch.int32, device=self.device)
         else:
-            self._latent_step_count = np.random.randint(self._latent_steps_min, self._latent_steps_max)
-        return
+            latent_step_count = torch.randint(self._latent_steps_min, self._latent_steps_max, (n,),
+                                              dtype=torch.int32, device=self.device)
+        return latent_step_count
 
     def _calc_amp_rewards(self, amp_obs, calm_latents):
         disc_r = self._calc_disc_rewards(amp_obs)
@@ -0,0 +1,147 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import threading
+
+import torch
+
+
+class DemoProducer:
+    def __init__(self, producers, queue_size, device):
+        # producers maps a name to a function returning a tuple of tensors. a background thread
+        # keeps up to queue_size results of each ready, running the functions on a side cuda stream
+        self._producers = producers
+        self._queue_size = queue_size
+        self._device = torch.device(device)
+        self._queues = {name: collections.deque() for name in producers.keys()}
+
+        self._stream = None
+        if self._device.type == "cuda":
+            self._stream = torch.cuda.Stream(device=self._device)
+
+        self._cond = threading.Condition()
+        self._paused = True
+        self._busy = False
+        self._stopped = False
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+        return
+
+    def pause(self):
+        # returns once the thread is idle, so the caller can use the motion library again
+        with self._cond:
+            self._paused = True
+            while self._busy:
+                self._cond.wait()
+        return
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        return
+
+    def get(self, name):
+        with self._cond:
+            queue = self._queues[name]
+            while len(queue) == 0 and not self._paused and self._error is None:
+                self._cond.wait()
+
+            if self._error is not None:
+                raise self._error
+
+            if len(queue) > 0:
+                data, event = queue.popleft()
+                self._cond.notify_all()
+            else:
+                data, event = self._producers[name](), None
+
+        if event is not None:
+            curr_stream = torch.cuda.current_stream(self._device)
+            curr_stream.wait_event(event)
+            for t in data:
+                t.record_stream(curr_stream)
+
+        return data
+
+    def _next_name(self):
+        # the queue with the fewest ready results is refilled first
+        name = min(self._queues.keys(), key=lambda k: len(self._queues[k]))
+        if len(self._queues[name]) >= self._queue_size:
+            name = None
+        return name
+
+    def _run(self):
+        while True:
+            with self._cond:
+                name = None
+                while not self._stopped:
+                    if not self._paused:
+                        name = self._next_name()
+                        if name is not None:
+                            break
+                    self._cond.wait()
+
+                if self._stopped:
+                    return
+                self._busy = True
+
+            try:
+                item = self._produce(name)
+            except Exception as e:
+                item = None
+                self._error = e
+
+            with self._cond:
+                if item is not None:
+                    self._queues[name].append(item)
+                else:
+                    self._paused = True
+                self._busy = False
+                self._cond.notify_all()
+        return
+
+    def _produce(self, name):
+        if self._stream is None:
+            return self._producers[name](), None
+
+        with torch.cuda.stream(self._stream):
+            data = self._producers[name]()
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return data, event
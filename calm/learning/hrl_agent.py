@@ -41,6 +41,12 @@ import learning.common_agent as common_agent
 import learning.calm_agent as calm_agent
 import learning.calm_models as calm_models
 import learning.calm_network_builder as calm_network_builder
+import learning.latent_index as latent_index
+import learning.llc_export as llc_export
+import learning.motion_encoding as motion_encoding
+
+# number of encoded demo windows the style reward is taken against
+NUM_ENCODED_MOTION_SAMPLES = 128
 
 
 class HRLAgent(common_agent.CommonAgent):
@@ -55,7 +61,9 @@ class HRLAgent(common_agent.CommonAgent):
         self._task_size = self.vec_env.env.task.get_task_obs_size()
         
         self._llc_steps = config['llc_steps']
-        llc_checkpoint = config['llc_checkpoint']
+        llc_checkpoint = config.get('llc_checkpoint', "")
+        if self._llc_frozen_checkpoint != "":
+            llc_checkpoint = self._llc_frozen_checkpoint
         assert(llc_checkpoint != "")
         self._build_llc(llc_config_params, llc_checkpoint)
 
@@ -66,23 +74,26 @@ class HRLAgent(common_agent.CommonAgent):
         obs = self.obs['obs']
 
         rewards = 0.0
-        disc_rewards = 0.0
         done_count = 0.0
         terminate_count = 0.0
-        for t in range(self._llc_steps):
-            llc_actions = self._compute_llc_action(obs, actions)
-            obs, curr_rewards, curr_dones, infos = self.vec_env.step(llc_actions)
-            
-            rewards += curr_rewards
-            done_count += curr_dones
-            terminate_count += infos['terminate']
-            
-            amp_obs = infos['amp_obs']
-            curr_disc_reward = self._calc_disc_reward(amp_obs)
-            disc_rewards += curr_disc_reward
+        with torch.no_grad():
+            # the latent is fixed over the LLC steps, so its style embedding is only computed once
+            llc_latents, use_hidden_latents = self._compute_llc_latents(actions)
+
+            for t in range(self._llc_steps):
+                llc_actions = self._compute_llc_action(obs, llc_latents, use_hidden_latents)
+                obs, curr_rewards, curr_dones, infos = self.vec_env.step(llc_actions)
+                
+                rewards += curr_rewards
+                done_count += curr_dones
+                terminate_count += infos['terminate']
+                
+                # the env overwrites its amp obs on every step, the disc rewards of all steps are evaluated together below
+                self._record_llc_step(t, infos)
+
+            disc_rewards = self._calc_llc_disc_rewards()
 
         rewards /= self._llc_steps
-        disc_rewards /= self._llc_steps
 
         dones = torch.zeros_like(done_count)
         dones[done_count > 0] = 1.0
@@ -100,9 +111,21 @@ class HRLAgent(common_agent.CommonAgent):
                 rewards = np.expand_dims(rewards, axis=1)
             return self.obs_to_tensors(obs), torch.from_numpy(rewards).to(self.ppo_device).float(), torch.from_numpy(dones).to(self.ppo_device), infos
 
+    def _record_llc_step(self, t, infos):
+        self._llc_amp_obs_buf[t] = infos['amp_obs']
+        return
+
+    def _calc_llc_disc_rewards(self):
+        # disc rewards of all LLC steps in one pass, averaged over the steps
+        amp_obs = self._llc_amp_obs_buf.view(-1, self._llc_amp_obs_buf.shape[-1])
+        disc_rewards = self._calc_disc_reward(amp_obs)
+        disc_rewards = disc_rewards.view(self._llc_steps, -1, disc_rewards.shape[-1]).mean(dim=0)
+        return disc_rewards
+
     def cast_obs(self, obs):
         obs = super().cast_obs(obs)
-        self._llc_agent.is_tensor_obses = self.is_tensor_obses
+        if self._llc_agent is not None:
+            self._llc_agent.is_tensor_obses = self.is_tensor_obses
         return obs
 
     def preprocess_actions(self, actions):
@@ -192,6 +215,23 @@ class HRLAgent(common_agent.CommonAgent):
         self._task_reward_w = config['task_reward_w']
         self._disc_reward_w = config['disc_reward_w']
         self._style_reward_w = config['style_reward_w']
+
+        # style rewards are taken against an index over every demo window instead of the 128 sampled ones
+        self._style_latent_index_type = config.get('style_latent_index_type', None)
+        self._style_latent_index_stride = config.get('style_latent_index_stride', 1)
+        self._style_latent_index_params = config.get('style_latent_index_params', {})
+        self._style_latent_index = None
+
+        # encodes the demo motions in one batched pass and keeps the table next to the LLC checkpoint
+        self._motion_encoding_cache = config.get('motion_encoding_cache', False)
+        # None spreads NUM_ENCODED_MOTION_SAMPLES windows over the motions, as many as the uncached path encodes
+        self._motion_encoding_clip_windows = config.get('motion_encoding_clip_windows', None)
+        self._motion_encoding_table = None
+
+        # LLC exported with export_llc.py, used in place of the full LLC agent when set
+        self._llc_frozen_checkpoint = config.get('llc_frozen_checkpoint', "")
+        self._llc_agent = None
+        self._frozen_llc = None
         return
 
     def _get_mean_rewards(self):
@@ -223,34 +263,72 @@ class HRLAgent(common_agent.CommonAgent):
         self.experience_buffer.tensor_dict['style_rewards'] = torch.zeros_like(self.experience_buffer.tensor_dict['rewards'])
         self.tensor_list += ['disc_rewards', 'style_rewards']
 
+        num_envs = self.vec_env.env.task.num_envs
+        num_amp_obs = self.vec_env.env.task.get_num_amp_obs()
+        self._llc_amp_obs_buf = torch.zeros((self._llc_steps, num_envs, num_amp_obs), dtype=torch.float32, device=self.ppo_device)
+
         return
 
     def _build_llc(self, config_params, checkpoint_file):
-        network_params = config_params['network']
+        if self._llc_frozen_checkpoint != "":
+            self._frozen_llc = llc_export.load_frozen_llc(checkpoint_file, self.ppo_device)
+            assert(self._frozen_llc.latent_dim == self._latent_dim)
+            print("Loaded frozen LLC from {:s}".format(checkpoint_file))
+        else:
+            network_params = config_params['network']
 
-        network_builder = calm_network_builder.CALMBuilder()
+            network_builder = calm_network_builder.CALMBuilder()
 
-        network_builder.load(network_params)
+            network_builder.load(network_params)
 
-        network = calm_models.ModelCALMContinuous(network_builder)
+            network = calm_models.ModelCALMContinuous(network_builder)
 
-        llc_agent_config = self._build_llc_agent_config(config_params, network)
+            llc_agent_config = self._build_llc_agent_config(config_params, network)
 
-        self._llc_agent = calm_agent.CALMAgent('llc', llc_agent_config)
+            self._llc_agent = calm_agent.CALMAgent('llc', llc_agent_config)
 
-        self._llc_agent.restore(checkpoint_file)
-        print("Loaded LLC checkpoint from {:s}".format(checkpoint_file))
-        self._llc_agent.set_eval()
+            self._llc_agent.restore(checkpoint_file)
+            print("Loaded LLC checkpoint from {:s}".format(checkpoint_file))
+            self._llc_agent.set_eval()
 
-        enc_amp_obs = self._llc_agent._fetch_amp_obs_demo(128)
-        if len(enc_amp_obs) == 2:
-            enc_amp_obs = enc_amp_obs[0]
+        if self._motion_encoding_cache:
+            num_clip_windows = self._motion_encoding_clip_windows
+            if num_clip_windows is None:
+                num_motions = self.vec_env.env.task._motion_lib.num_motions()
+                num_clip_windows = int(np.ceil(NUM_ENCODED_MOTION_SAMPLES / num_motions))
+            window_stride = self._style_latent_index_stride if self._style_latent_index_type is not None else 0
+            self._motion_encoding_table = motion_encoding.load_motion_encoding_table(checkpoint_file, self.vec_env.env.task,
+                                                                                     self._encode_llc_amp_obs_demo,
+                                                                                     self.ppo_device,
+                                                                                     num_clip_windows,
+                                                                                     window_stride)
+            self.encoded_motion = self._motion_encoding_table.clip_latents.view(1, -1, self._latent_dim)
+        else:
+            _, _, enc_amp_obs = self.vec_env.env.fetch_amp_obs_demo_enc(NUM_ENCODED_MOTION_SAMPLES)
+            with torch.no_grad():
+                self.encoded_motion = self._encode_llc_amp_obs_demo(enc_amp_obs).unsqueeze(0)
 
-        preproc_enc_amp_obs = self._llc_agent._preproc_amp_obs(enc_amp_obs)
-        self.encoded_motion = self._llc_agent.model.a2c_network.eval_enc(amp_obs=preproc_enc_amp_obs).unsqueeze(0)
+        if self._style_latent_index_type is not None:
+            self._style_latent_index = self._build_style_latent_index()
 
         return
 
+    def _build_style_latent_index(self):
+        table = self._motion_encoding_table
+        if table is not None and table.has_windows():
+            latents, motion_ids, motion_times = table.window_latents, table.window_motion_ids, table.window_motion_times
+        else:
+            task = self.vec_env.env.task
+            motion_ids, motion_times = task.get_amp_obs_demo_enc_windows(self._style_latent_index_stride)
+            latents = motion_encoding.encode_amp_obs_demo_windows(task, self._encode_llc_amp_obs_demo, motion_ids, motion_times,
+                                                                  self.ppo_device)
+            motion_ids = motion_ids.to(self.ppo_device)
+            motion_times = motion_times.to(self.ppo_device)
+
+        index = latent_index.build_latent_index(self._style_latent_index_type, latents, motion_ids, motion_times,
+                                                **self._style_latent_index_params)
+        return index
+
     def _build_llc_agent_config(self, config_params, network):
         llc_env_info = copy.deepcopy(self.env_info)
         obs_space = llc_env_info['observation_space']
@@ -271,12 +349,30 @@ class HRLAgent(common_agent.CommonAgent):
 
         return config
 
-    def _compute_llc_action(self, obs, actions):
+    def _compute_llc_latents(self, actions):
+        # returns the LLC actor input for the latents, the style embedding when the actor has one
+        z = torch.nn.functional.normalize(actions, dim=-1)
+        if self._frozen_llc is not None:
+            return self._frozen_llc.eval_style(z), True
+
+        actor_mlp = self._llc_agent.model.a2c_network.actor_mlp
+        if hasattr(actor_mlp, 'eval_style'):
+            return actor_mlp.eval_style(z), True
+        return z, False
+
+    def _compute_llc_action(self, obs, llc_latents, use_hidden_latents):
         llc_obs = self._extract_llc_obs(obs)
+        if self._frozen_llc is not None:
+            llc_action = self._frozen_llc(llc_obs, llc_latents, use_hidden_latents)
+            if self._frozen_llc.clip_actions:
+                llc_action = a2c_common.rescale_actions(self.actions_low, self.actions_high, torch.clamp(llc_action, -1.0, 1.0))
+            if not self.is_tensor_obses:
+                llc_action = llc_action.cpu().numpy()
+            return llc_action
+
         processed_obs = self._llc_agent._preproc_obs(llc_obs)
 
-        z = torch.nn.functional.normalize(actions, dim=-1)
-        mu, _ = self._llc_agent.model.a2c_network.eval_actor(processed_obs, z)
+        mu, _ = self._llc_agent.model.a2c_network.eval_actor(processed_obs, llc_latents, use_hidden_latents)
         llc_action = mu
         llc_action = self._llc_agent.preprocess_actions(llc_action)
 
@@ -288,12 +384,28 @@ class HRLAgent(common_agent.CommonAgent):
         return llc_obs
 
     def _calc_disc_reward(self, amp_obs):
+        if self._frozen_llc is not None:
+            return self._frozen_llc.calc_disc_rewards(amp_obs)
         disc_reward = self._llc_agent._calc_disc_rewards(amp_obs)
         return disc_reward
 
+    def _calc_llc_conditional_disc_rewards(self, amp_obs, latents):
+        if self._frozen_llc is not None:
+            return self._frozen_llc.calc_conditional_disc_rewards(amp_obs, latents)
+        return self._llc_agent._calc_conditional_disc_rewards(amp_obs, latents)
+
+    def _encode_llc_amp_obs_demo(self, enc_amp_obs):
+        if self._frozen_llc is not None:
+            return self._frozen_llc.encode_amp_obs_demo(enc_amp_obs)
+        return self._llc_agent.encode_amp_obs_demo(enc_amp_obs)
+
     def _calc_style_reward(self, action):
         z = torch.nn.functional.normalize(action, dim=-1)
-        style_reward = torch.max((cosine_similarity(z.unsqueeze(1), self.encoded_motion, dim=-1) + 1) / 2, dim=1)[0]
+        if self._style_latent_index is not None:
+            sims, _ = self._style_latent_index.search(z, k=1)
+            style_reward = (sims[:, 0] + 1) / 2
+        else:
+            style_reward = torch.max((cosine_similarity(z.unsqueeze(1), self.encoded_motion, dim=-1) + 1) / 2, dim=1)[0]
         return style_reward.unsqueeze(-1)
 
     def _combine_rewards(self, task_rewards, disc_rewards, style_rewards):
@@ -33,6 +33,9 @@ from torch.nn.functional import cosine_similarity
 
 from learning.hrl_agent import HRLAgent
 
+# number of encoded windows per motion, the disc reward conditions on one of them at random
+NUM_MOTION_ENCODING_SAMPLES = 32
+
 
 class HRLConditionedAgent(HRLAgent):
     def __init__(self, base_name, config):
@@ -40,18 +43,34 @@ class HRLConditionedAgent(HRLAgent):
 
         return
 
+    def _load_config_params(self, config):
+        super()._load_config_params(config)
+
+        # the cached table must hold as many windows per motion as the uncached path encodes
+        self._motion_encoding_clip_windows = config.get('motion_encoding_clip_windows', NUM_MOTION_ENCODING_SAMPLES)
+        return
+
+    def init_tensors(self):
+        super().init_tensors()
+
+        num_envs = self.vec_env.env.task.num_envs
+        self._llc_requested_motion_buf = torch.zeros((self._llc_steps, num_envs), dtype=torch.long, device=self.ppo_device)
+        return
+
     def _build_llc(self, config_params, checkpoint_file):
         super()._build_llc(config_params, checkpoint_file)
 
         self.encoded_motion = self._get_motion_encoding()
 
     def _get_motion_encoding(self):
+        if self._motion_encoding_table is not None:
+            return self._motion_encoding_table.clip_latents
+
         all_encoded_demo_amp_obs = []
         for motion_id in range(self.vec_env.env.task._motion_lib._motion_weights.shape[0]):
-            motion_amp_obs = self.vec_env.env.task.fetch_amp_obs_demo_per_id(32, motion_id)[-1].view(32, self.vec_env.env.task._num_amp_obs_enc_steps, self.vec_env.env.task._num_amp_obs_per_step)
+            motion_amp_obs = self.vec_env.env.task.fetch_amp_obs_demo_per_id(NUM_MOTION_ENCODING_SAMPLES, motion_id)[-1].view(NUM_MOTION_ENCODING_SAMPLES, self.vec_env.env.task._num_amp_obs_enc_steps, self.vec_env.env.task._num_amp_obs_per_step)
 
-            preproc_amp_obs = self._llc_agent._preproc_amp_obs(motion_amp_obs)
-            encoded_demo_amp_obs = self._llc_agent.model.a2c_network.eval_enc(preproc_amp_obs)
+            encoded_demo_amp_obs = self._encode_llc_amp_obs_demo(motion_amp_obs)
             all_encoded_demo_amp_obs.append(encoded_demo_amp_obs)
         all_encoded_demo_amp_obs = torch.stack(all_encoded_demo_amp_obs, dim=0)
 
@@ -68,15 +87,38 @@ class HRLConditionedAgent(HRLAgent):
 
         return style_reward.unsqueeze(-1)
 
-    def _calc_disc_reward(self, amp_obs):
-        requested_motion_indices = self.vec_env.env.task._tar_locomotion_index.view(-1)
+    def _record_llc_step(self, t, infos):
+        super()._record_llc_step(t, infos)
+        self._llc_requested_motion_buf[t] = self.vec_env.env.task._tar_locomotion_index.view(-1)
+        return
+
+    def _calc_llc_disc_rewards(self):
+        # every LLC step is scored against the motion requested at that step, with its own latent draw
+        num_envs = self._llc_requested_motion_buf.shape[1]
+        latent_indices = np.random.randint(low=0, high=self.encoded_motion.shape[1], size=self._llc_steps)
+        latent_indices = torch.from_numpy(latent_indices).to(self.ppo_device).view(-1, 1).expand(-1, num_envs)
+
+        amp_obs = self._llc_amp_obs_buf.view(-1, self._llc_amp_obs_buf.shape[-1])
+        disc_rewards = self._calc_disc_reward(amp_obs, self._llc_requested_motion_buf.view(-1), latent_indices.reshape(-1))
+        disc_rewards = disc_rewards.view(self._llc_steps, -1, disc_rewards.shape[-1]).mean(dim=0)
+        return disc_rewards
+
+    def _calc_disc_reward(self, amp_obs, requested_motion_indices=None, latent_indices=None):
+        # requested_motion_indices and latent_indices give the motion and the encoded window of every row,
+        # by default all rows use the current requests and a single window
+        if requested_motion_indices is None:
+            requested_motion_indices = self.vec_env.env.task._tar_locomotion_index.view(-1)
 
         disc_reward = torch.zeros((amp_obs.shape[0], 1), device=self.ppo_device, dtype=torch.float32)
 
-        latent_index = np.random.randint(low=0, high=32)
+        if latent_indices is None:
+            latent_index = np.random.randint(low=0, high=self.encoded_motion.shape[1])
+            latents = self.encoded_motion[0][latent_index].view(1, self._latent_dim).expand(amp_obs.shape[0], -1)
+        else:
+            latents = self.encoded_motion[0][latent_indices]
 
         for motion_type in range(3):  # TODO: currently hardcoded to 3 motions.
             motion_mask = requested_motion_indices == motion_type
-            disc_reward[motion_mask] = self._llc_agent._calc_conditional_disc_rewards(amp_obs[motion_mask], self.encoded_motion[0][latent_index].view(1, self._latent_dim).expand(amp_obs.shape[0], -1)[motion_mask])
+            disc_reward[motion_mask] = self._calc_llc_conditional_disc_rewards(amp_obs[motion_mask], latents[motion_mask])
 
         return disc_reward
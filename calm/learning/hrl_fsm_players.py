@@ -29,35 +29,21 @@
 import torch 
 
 from learning.hrl_players import HRLPlayer
+import learning.motion_encoding as motion_encoding
 
 
 class HRLFSMPlayer(HRLPlayer):
     def _build_llc(self, config_params, checkpoint_file):
         super()._build_llc(config_params, checkpoint_file)
 
-        self.env.task._possible_latents = self._get_motion_encoding()
+        self.env.task._possible_latents = self._get_motion_encoding(checkpoint_file)
 
-    def _get_motion_encoding(self):
-        all_encoded_demo_amp_obs = []
-        for motion_id in range(self.env.task._motion_lib._motion_weights.shape[0]):
-            motion_len = self.env.task._motion_lib._motion_lengths[motion_id]
-            motion_time = torch.clamp(
-                torch.clamp(motion_len - self.env.task.dt * self.env.task._num_amp_obs_enc_steps, min=0) / 2 + self.env.task.dt * self.env.task._num_amp_obs_enc_steps,
-                max=motion_len.item()
-            )
-
-            motion_amp_obs = self.env.task.build_amp_obs_demo(
-                torch.tensor([motion_id], device=self.device),
-                motion_time,
-                self.env.task._num_amp_obs_enc_steps
-            ).view(-1, self.env.task._num_amp_obs_enc_steps, self.env.task._num_amp_obs_per_step)
-
-            preproc_amp_obs = self._llc_agent._preproc_amp_obs(motion_amp_obs)
-            encoded_demo_amp_obs = self._llc_agent.model.a2c_network.eval_enc(preproc_amp_obs)
-            all_encoded_demo_amp_obs.append(encoded_demo_amp_obs)
-        all_encoded_demo_amp_obs = torch.cat(all_encoded_demo_amp_obs, dim=0)
-
-        return all_encoded_demo_amp_obs
+    def _get_motion_encoding(self, checkpoint_file):
+        # one window in the middle of every clip, encoded in a single batched pass
+        table = motion_encoding.load_motion_encoding_table(checkpoint_file, self.env.task, self._encode_llc_amp_obs_demo,
+                                                           self.device, num_clip_windows=1,
+                                                           use_cache=self._motion_encoding_cache)
+        return table.clip_latents[:, 0]
 
     def env_step(self, env, obs_dict, action):
         requested_behavior = env.task.movement_type.value
@@ -39,6 +39,7 @@ import learning.common_player as common_player
 import learning.calm_players as calm_players
 import learning.calm_models as calm_models
 import learning.calm_network_builder as calm_network_builder
+import learning.llc_export as llc_export
 
 
 class HRLPlayer(common_player.CommonPlayer):
@@ -53,7 +54,13 @@ class HRLPlayer(common_player.CommonPlayer):
         self._task_size = self.env.task.get_task_obs_size()
         
         self._llc_steps = config['llc_steps']
-        llc_checkpoint = config['llc_checkpoint']
+        self._motion_encoding_cache = config.get('motion_encoding_cache', False)
+        self._llc_frozen_checkpoint = config.get('llc_frozen_checkpoint', "")
+        self._llc_agent = None
+        self._frozen_llc = None
+        llc_checkpoint = config.get('llc_checkpoint', "")
+        if self._llc_frozen_checkpoint != "":
+            llc_checkpoint = self._llc_frozen_checkpoint
         assert(llc_checkpoint != "")
         self._build_llc(llc_config_params, llc_checkpoint)
 
@@ -234,6 +241,12 @@ class HRLPlayer(common_player.CommonPlayer):
             return torch.from_numpy(obs).to(self.device), torch.from_numpy(rewards), torch.from_numpy(dones), infos
     
     def _build_llc(self, config_params, checkpoint_file):
+        if self._llc_frozen_checkpoint != "":
+            self._frozen_llc = llc_export.load_frozen_llc(checkpoint_file, self.device)
+            assert(self._frozen_llc.latent_dim == self._latent_dim)
+            print("Loaded frozen LLC from {:s}".format(checkpoint_file))
+            return
+
         network_params = config_params['network']
 
         network_builder = calm_network_builder.CALMBuilder()
@@ -274,10 +287,12 @@ class HRLPlayer(common_player.CommonPlayer):
 
     def _compute_llc_action(self, obs, actions):
         llc_obs = self._extract_llc_obs(obs)
-        processed_obs = self._llc_agent._preproc_obs(llc_obs)
-
         z = torch.nn.functional.normalize(actions, dim=-1)
-        mu, _ = self._llc_agent.model.a2c_network.eval_actor(processed_obs, z)
+        if self._frozen_llc is not None:
+            mu = self._frozen_llc(llc_obs, z)
+        else:
+            processed_obs = self._llc_agent._preproc_obs(llc_obs)
+            mu, _ = self._llc_agent.model.a2c_network.eval_actor(processed_obs, z)
         llc_action = players.rescale_actions(self.actions_low, self.actions_high, torch.clamp(mu, -1.0, 1.0))
 
         return llc_action
@@ -288,5 +303,12 @@ class HRLPlayer(common_player.CommonPlayer):
         return llc_obs
     
     def _calc_disc_reward(self, amp_obs):
+        if self._frozen_llc is not None:
+            return self._frozen_llc.calc_disc_rewards(amp_obs)
         disc_reward = self._llc_agent._calc_disc_rewards(amp_obs)
         return disc_reward
+
+    def _encode_llc_amp_obs_demo(self, enc_amp_obs):
+        if self._frozen_llc is not None:
+            return self._frozen_llc.encode_amp_obs_demo(enc_amp_obs)
+        return self._llc_agent.encode_amp_obs_demo(enc_amp_obs)
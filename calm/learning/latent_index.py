@@ -0,0 +1,252 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import torch
+
+
+LATENT_INDEX_TYPES = ['flat', 'ivfpq']
+
+
+def build_latent_index(index_type, latents, motion_ids=None, motion_times=None, **kwargs):
+    assert(index_type in LATENT_INDEX_TYPES), "Unsupported latent index type: {}".format(index_type)
+
+    if index_type == 'flat':
+        index = LatentIndex(latents, motion_ids, motion_times, **kwargs)
+    else:
+        index = IVFPQLatentIndex(latents, motion_ids, motion_times, **kwargs)
+    return index
+
+
+class LatentIndex:
+    def __init__(self, latents, motion_ids=None, motion_times=None, max_chunk_elems=2**24):
+        # exact inner product search over unit latents. the queries are scored against the latents
+        # in chunks, so the full similarity matrix is never held at once
+        self._latents = torch.nn.functional.normalize(latents.float(), dim=-1)
+        self._num_latents = latents.shape[0]
+        self._motion_ids = motion_ids
+        self._motion_times = motion_times
+        self._max_chunk_elems = max_chunk_elems
+        return
+
+    def num_latents(self):
+        return self._num_latents
+
+    def get_latents(self, idx):
+        assert(self._latents is not None), "Latent index does not keep the latents"
+        return self._latents[idx]
+
+    def search(self, queries, k=1):
+        # returns the top k inner products with the unit queries and the latent indices, both [num_queries, k].
+        # the similarities are clamped to [-1, 1], since quantized scores can leave that range. slots without
+        # a result have index -1 and similarity -1
+        queries = torch.nn.functional.normalize(queries.float(), dim=-1)
+        k = min(k, self._num_latents)
+        sims, idx = self._search(queries, k)
+        sims = torch.clamp(sims, -1.0, 1.0)
+        return sims, idx
+
+    def lookup(self, queries, k=1):
+        # returns the similarities and the motion ids and times of the windows closest to the queries,
+        # slots without a result have motion id -1 and motion time -1
+        assert(self._motion_ids is not None and self._motion_times is not None)
+        sims, idx = self.search(queries, k)
+        valid = idx >= 0
+        safe_idx = torch.clamp(idx, min=0)
+        motion_ids = torch.where(valid, self._motion_ids[safe_idx], torch.full_like(idx, -1, dtype=self._motion_ids.dtype))
+        motion_times = torch.where(valid, self._motion_times[safe_idx], torch.full_like(sims, -1, dtype=self._motion_times.dtype))
+        return sims, motion_ids, motion_times
+
+    def _search(self, queries, k):
+        num_queries = queries.shape[0]
+        chunk_size = max(k, self._max_chunk_elems // max(num_queries, 1))
+
+        best_sims = None
+        best_idx = None
+        for start in range(0, self._num_latents, chunk_size):
+            end = min(start + chunk_size, self._num_latents)
+            sims = torch.matmul(queries, self._latents[start:end].t())
+            sims, idx = torch.topk(sims, min(k, end - start), dim=-1)
+            idx += start
+            best_sims, best_idx = _merge_topk(best_sims, best_idx, sims, idx, k)
+
+        return best_sims, best_idx
+
+
+class IVFPQLatentIndex(LatentIndex):
+    def __init__(self, latents, motion_ids=None, motion_times=None, num_lists=1024, num_probes=16,
+                 num_subspaces=8, num_codes=256, num_train=65536, num_iters=20, rerank=0, keep_latents=True,
+                 max_chunk_elems=2**24):
+        # approximate inner product search. the latents are split into num_lists inverted lists by a
+        # coarse k-means, and the residuals to the list centroids are product quantized into num_subspaces
+        # codes of one byte each. a search scores only the latents of the num_probes closest lists,
+        # optionally rescoring the best rerank candidates with the exact latents.
+        # with num_subspaces 0 the lists keep the exact latents and are scored exactly
+        super().__init__(latents, motion_ids, motion_times, max_chunk_elems)
+
+        latent_dim = latents.shape[-1]
+        assert(num_subspaces == 0 or latent_dim % num_subspaces == 0), "Latent dim must be divisible by the number of subspaces"
+        assert(num_codes <= 256)
+        assert(rerank == 0 or keep_latents), "Reranking needs the exact latents"
+
+        num_lists = min(num_lists, self._num_latents)
+        self._num_lists = num_lists
+        self._num_probes = min(num_probes, num_lists)
+        self._num_subspaces = num_subspaces
+        self._cand_dim = num_subspaces if num_subspaces > 0 else latent_dim
+        self._num_codes = num_codes
+        self._rerank = rerank
+
+        x = self._latents
+        device = x.device
+        train_ids = torch.randperm(self._num_latents, device=device)[:max(num_train, num_lists)]
+        train_x = x[train_ids]
+
+        self._centroids = _kmeans(train_x, num_lists, num_iters, spherical=True)
+        list_ids = _assign(x, self._centroids, max_chunk_elems)
+
+        # the lists are stored back to back, sorted by list. the row index breaks ties, so the rows of a list
+        # keep their order without a stable sort
+        rows = torch.arange(self._num_latents, dtype=torch.long, device=device)
+        order = torch.argsort(list_ids.long() * self._num_latents + rows)
+        list_sizes = torch.bincount(list_ids, minlength=num_lists)
+        self._list_starts = torch.cumsum(list_sizes, dim=0) - list_sizes
+        self._list_sizes = list_sizes
+        self._max_list_size = int(list_sizes.max())
+        self._list_rows = order
+
+        self._codebooks = None
+        self._list_codes = None
+        self._list_latents = None
+        if num_subspaces > 0:
+            sub_dim = latent_dim // num_subspaces
+            residuals = (x - self._centroids[list_ids]).view(-1, num_subspaces, sub_dim)
+            train_residuals = residuals[train_ids]
+            self._codebooks = torch.stack([_kmeans(train_residuals[:, m], num_codes, num_iters) for m in range(num_subspaces)], dim=0)
+
+            codes = torch.stack([_assign(residuals[:, m], self._codebooks[m], max_chunk_elems, ip=False) for m in range(num_subspaces)], dim=-1)
+            self._list_codes = codes[order].to(torch.uint8)
+        else:
+            self._list_latents = x[order]
+
+        if not keep_latents:
+            self._latents = None
+
+        return
+
+    def _search(self, queries, k):
+        num_queries = queries.shape[0]
+        num_cands = self._num_probes * self._max_list_size
+        num_keep = min(max(k, self._rerank), num_cands)
+        chunk_size = max(1, self._max_chunk_elems // (num_cands * self._cand_dim))
+
+        all_sims = []
+        all_idx = []
+        for start in range(0, num_queries, chunk_size):
+            end = min(start + chunk_size, num_queries)
+            sims, idx = self._search_chunk(queries[start:end], num_keep)
+            if self._rerank > 0:
+                exact_sims = torch.sum(queries[start:end].unsqueeze(1) * self._latents[torch.clamp(idx, min=0)], dim=-1)
+                sims = torch.where(torch.isinf(sims), sims, exact_sims)
+                sims, order = torch.topk(sims, min(k, num_keep), dim=-1)
+                idx = torch.gather(idx, 1, order)
+            else:
+                sims = sims[:, :k]
+                idx = idx[:, :k]
+            all_sims.append(sims)
+            all_idx.append(idx)
+
+        return torch.cat(all_sims, dim=0), torch.cat(all_idx, dim=0)
+
+    def _search_chunk(self, queries, k):
+        num_queries = queries.shape[0]
+        coarse_sims, probes = torch.topk(torch.matmul(queries, self._centroids.t()), self._num_probes, dim=-1)
+
+        # every probed list is padded to the longest list, the padding is masked out below
+        offsets = torch.arange(self._max_list_size, device=queries.device)
+        pos = self._list_starts[probes].unsqueeze(-1) + offsets
+        valid = offsets < self._list_sizes[probes].unsqueeze(-1)
+        pos = torch.where(valid, pos, torch.zeros_like(pos)).view(num_queries, -1)
+
+        if self._list_codes is not None:
+            # inner products of each query subvector with each codeword, summed over the codes of a candidate
+            sub_queries = queries.view(num_queries, self._num_subspaces, -1)
+            lut = torch.einsum('bmd,mcd->bmc', sub_queries, self._codebooks)
+            codes = self._list_codes[pos].long().transpose(1, 2)
+            sims = torch.gather(lut, 2, codes).sum(dim=1)
+            sims += coarse_sims.unsqueeze(-1).expand(-1, -1, self._max_list_size).reshape(num_queries, -1)
+        else:
+            sims = torch.bmm(self._list_latents[pos], queries.unsqueeze(-1)).squeeze(-1)
+        sims = torch.where(valid.view(num_queries, -1), sims, torch.full_like(sims, -float('inf')))
+
+        # fewer than k valid candidates leaves padded slots in the top k, they get index -1
+        sims, cand = torch.topk(sims, k, dim=-1)
+        idx = self._list_rows[torch.gather(pos, 1, cand)]
+        idx = torch.where(torch.isinf(sims), torch.full_like(idx, -1), idx)
+        return sims, idx
+
+
+def _merge_topk(sims0, idx0, sims1, idx1, k):
+    if sims0 is None:
+        return sims1, idx1
+
+    sims = torch.cat([sims0, sims1], dim=-1)
+    idx = torch.cat([idx0, idx1], dim=-1)
+    sims, order = torch.topk(sims, min(k, sims.shape[-1]), dim=-1)
+    idx = torch.gather(idx, 1, order)
+    return sims, idx
+
+
+def _assign(x, centroids, max_chunk_elems, ip=True):
+    # index of the closest centroid, by inner product or by euclidean distance
+    chunk_size = max(1, max_chunk_elems // centroids.shape[0])
+    centroid_sq_norms = torch.sum(centroids * centroids, dim=-1)
+
+    ids = []
+    for start in range(0, x.shape[0], chunk_size):
+        scores = torch.matmul(x[start:start + chunk_size], centroids.t())
+        if not ip:
+            scores = 2 * scores - centroid_sq_norms
+        ids.append(torch.argmax(scores, dim=-1))
+    return torch.cat(ids, dim=0)
+
+
+def _kmeans(x, k, num_iters, spherical=False):
+    k = min(k, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], device=x.device)[:k]].clone()
+
+    for i in range(num_iters):
+        ids = _assign(x, centroids, 2**24, ip=spherical)
+        sums = torch.zeros_like(centroids).index_add_(0, ids, x)
+        counts = torch.bincount(ids, minlength=k).unsqueeze(-1)
+
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        if spherical:
+            centroids = torch.nn.functional.normalize(centroids, dim=-1)
+
+    return centroids
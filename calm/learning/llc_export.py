@@ -0,0 +1,263 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import copy
+import os
+
+import torch
+import torch.nn as nn
+
+from rl_games.algos_torch import torch_ext
+
+import learning.calm_network_builder as calm_network_builder
+
+
+FROZEN_LLC_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+# same constants as rl_games' RunningMeanStd
+NORM_EPS = 1e-5
+NORM_CLIP = 5.0
+
+# exported methods and attributes kept when the scripted module is frozen
+FROZEN_LLC_METHODS = ["eval_style", "normalize_obs", "normalize_amp_obs", "calc_disc_rewards",
+                      "calc_conditional_disc_rewards", "encode_amp_obs_demo"]
+FROZEN_LLC_ATTRS = ["obs_size", "num_actions", "latent_dim", "num_amp_obs_per_step", "clip_actions",
+                    "disc_reward_scale", "conditional_disc_reward_scale"]
+
+
+class _StyleCatMLP(nn.Module):
+    # the layers of an AMPStyleCatNet1, with the style embedding split out so it can be computed once and reused
+    def __init__(self, net):
+        super().__init__()
+        self._style_mlp = net._style_mlp
+        self._style_dense = net._style_dense
+        self._dense_layers = net._dense_layers
+        self._activation = net._activation
+        return
+
+    def eval_style(self, latents):
+        style_h = self._style_mlp(latents)
+        style = torch.tanh(self._style_dense(style_h))
+        return style
+
+    def forward(self, x, style):
+        h = torch.cat([x, style], dim=-1)
+        for dense in self._dense_layers:
+            h = self._activation(dense(h))
+        return h
+
+
+class FrozenLLC(nn.Module):
+    """
+    Inference only copy of a CALM low-level controller: the actor, discriminator, conditional discriminator
+    and encoder of the network, with the input normalizers folded into a single scale and shift. The critic,
+    sigma and optimizer state are dropped. Inputs and outputs are float32, the layers may be kept in half
+    precision.
+    """
+    def __init__(self, network, obs_mean_std=None, amp_obs_mean_std=None, disc_reward_scale=1.0,
+                 conditional_disc_reward_scale=1.0, clip_actions=True, dtype=torch.float32):
+        super().__init__()
+        network = copy.deepcopy(network)
+
+        self._actor = _StyleCatMLP(network.actor_mlp)
+        self._mu = network.mu
+        self._mu_act = network.mu_act
+        self._disc_mlp = network._disc_mlp
+        self._disc_logits = network._disc_logits
+        self._cond_disc = _StyleCatMLP(network._cond_disc_mlp)
+        self._cond_disc_logits = network._cond_disc_logits
+        self._enc = network._enc
+
+        self.obs_size = self._actor._dense_layers[0].in_features - self._actor._style_dense.out_features
+        self.num_actions = self._mu.out_features
+        self.latent_dim = self._actor._style_mlp[0].in_features
+        self.num_amp_obs_per_step = network._num_amp_obs_per_step
+        self.clip_actions = bool(clip_actions)
+        self.disc_reward_scale = float(disc_reward_scale)
+        self.conditional_disc_reward_scale = float(conditional_disc_reward_scale)
+
+        self._normalize_obs = obs_mean_std is not None
+        self._normalize_amp_obs = amp_obs_mean_std is not None
+        self._norm_clip = NORM_CLIP
+        obs_scale, obs_shift = _fuse_mean_std(obs_mean_std, self.obs_size)
+        amp_obs_scale, amp_obs_shift = _fuse_mean_std(amp_obs_mean_std, self.num_amp_obs_per_step)
+        self.register_buffer("_obs_scale", obs_scale)
+        self.register_buffer("_obs_shift", obs_shift)
+        self.register_buffer("_amp_obs_scale", amp_obs_scale)
+        self.register_buffer("_amp_obs_shift", amp_obs_shift)
+
+        # only the layers are cast, the normalizer buffers stay in float32
+        for module in [self._actor, self._mu, self._disc_mlp, self._disc_logits, self._cond_disc,
+                       self._cond_disc_logits, self._enc]:
+            module.to(dtype)
+
+        self.requires_grad_(False)
+        self.eval()
+        return
+
+    def forward(self, obs, llc_latents, use_hidden_latents: bool = False):
+        # returns the actor mean for unnormalized obs, llc_latents are style embeddings if use_hidden_latents
+        dtype = self._mu.weight.dtype
+        if use_hidden_latents:
+            style = llc_latents
+        else:
+            style = self.eval_style(llc_latents)
+
+        obs = self.normalize_obs(obs)
+        h = self._actor(obs.to(dtype), style.to(dtype))
+        mu = self._mu_act(self._mu(h))
+        return mu.float()
+
+    @torch.jit.export
+    def eval_style(self, latents):
+        dtype = self._mu.weight.dtype
+        style = self._actor.eval_style(latents.to(dtype))
+        return style.float()
+
+    @torch.jit.export
+    def normalize_obs(self, obs):
+        obs = obs.float()
+        if self._normalize_obs:
+            obs = torch.clamp(torch.addcmul(self._obs_shift, obs, self._obs_scale), -self._norm_clip, self._norm_clip)
+        return obs
+
+    @torch.jit.export
+    def normalize_amp_obs(self, amp_obs):
+        # the amp normalizer is shared by all steps of the amp obs
+        amp_obs = amp_obs.float()
+        if self._normalize_amp_obs:
+            shape = amp_obs.shape
+            amp_obs = amp_obs.reshape(-1, self.num_amp_obs_per_step)
+            amp_obs = torch.clamp(torch.addcmul(self._amp_obs_shift, amp_obs, self._amp_obs_scale), -self._norm_clip, self._norm_clip)
+            amp_obs = amp_obs.view(shape)
+        return amp_obs
+
+    @torch.jit.export
+    def calc_disc_rewards(self, amp_obs):
+        dtype = self._disc_logits.weight.dtype
+        proc_amp_obs = self.normalize_amp_obs(amp_obs)
+        disc_logits = self._disc_logits(self._disc_mlp(proc_amp_obs.to(dtype))).float()
+        return self._disc_logits_to_rewards(disc_logits) * self.disc_reward_scale
+
+    @torch.jit.export
+    def calc_conditional_disc_rewards(self, amp_obs, latents):
+        dtype = self._cond_disc_logits.weight.dtype
+        proc_amp_obs = self.normalize_amp_obs(amp_obs)
+        style = self._cond_disc.eval_style(latents.to(dtype))
+        disc_logits = self._cond_disc_logits(self._cond_disc(proc_amp_obs.to(dtype), style)).float()
+        return self._disc_logits_to_rewards(disc_logits) * self.conditional_disc_reward_scale
+
+    @torch.jit.export
+    def encode_amp_obs_demo(self, enc_amp_obs):
+        dtype = self._enc[1].weight.dtype
+        proc_enc_amp_obs = self.normalize_amp_obs(enc_amp_obs)
+        proc_enc_amp_obs = proc_enc_amp_obs.view(proc_enc_amp_obs.shape[0], -1)
+        enc_output = self._enc(proc_enc_amp_obs.to(dtype)).float()
+        return torch.nn.functional.normalize(enc_output, dim=-1)
+
+    def _disc_logits_to_rewards(self, disc_logits):
+        prob = torch.sigmoid(disc_logits)
+        return -torch.log(torch.clamp_min(1 - prob, 0.0001))
+
+
+def _fuse_mean_std(mean_std, size):
+    # folds (x - mean) / sqrt(var + eps) into x * scale + shift, computed in float64 before the cast
+    if mean_std is None:
+        return torch.ones(size, dtype=torch.float32), torch.zeros(size, dtype=torch.float32)
+
+    mean = mean_std["running_mean"].double().cpu()
+    var = mean_std["running_var"].double().cpu()
+    assert(mean.shape[0] == size)
+    scale = 1.0 / torch.sqrt(var + NORM_EPS)
+    shift = -mean * scale
+    return scale.float(), shift.float()
+
+
+def build_frozen_llc(config_params, checkpoint, dtype=torch.float32):
+    # config_params are the params of the LLC training config, checkpoint a loaded CALM checkpoint
+    network_params = config_params["network"]
+    config = config_params["config"]
+    latent_dim = config["latent_dim"]
+
+    prefix = "a2c_network."
+    model_state = {k[len(prefix):]: v for k, v in checkpoint["model"].items() if k.startswith(prefix)}
+
+    obs_size = model_state["actor_mlp._dense_layers.0.weight"].shape[1] - latent_dim
+    num_actions = model_state["mu.weight"].shape[0]
+    num_amp_obs = model_state["_disc_mlp.0.weight"].shape[1]
+    # the encoder sees 60 steps of amp obs, see CALMBuilder.Network._build_linear_enc
+    num_amp_obs_per_step = model_state["_enc.0.0.weight"].shape[1] // 60
+
+    network_builder = calm_network_builder.CALMBuilder()
+    network_builder.load(network_params)
+    network = network_builder.build("calm",
+                                    actions_num=num_actions,
+                                    input_shape=(obs_size,),
+                                    value_size=model_state["value.weight"].shape[0],
+                                    amp_input_shape=(num_amp_obs,),
+                                    calm_latent_shape=(latent_dim,),
+                                    amp_obs_steps=num_amp_obs // num_amp_obs_per_step)
+    network.load_state_dict(model_state)
+
+    frozen_llc = FrozenLLC(network,
+                           obs_mean_std=checkpoint.get("running_mean_std", None),
+                           amp_obs_mean_std=checkpoint.get("amp_input_mean_std", None),
+                           disc_reward_scale=config["disc_reward_scale"],
+                           conditional_disc_reward_scale=config["conditional_disc_reward_scale"],
+                           clip_actions=config.get("clip_actions", True),
+                           dtype=dtype)
+    return frozen_llc
+
+
+def script_frozen_llc(frozen_llc):
+    # freezing inlines the weights as constants, which lets TorchScript fold and fuse the layers
+    scripted = torch.jit.script(frozen_llc.eval())
+    scripted = torch.jit.freeze(scripted, preserved_attrs=FROZEN_LLC_METHODS + FROZEN_LLC_ATTRS)
+    return scripted
+
+
+def export_llc(config_params, checkpoint_file, output_file, dtype=torch.float32):
+    checkpoint = torch_ext.load_checkpoint(checkpoint_file)
+    frozen_llc = build_frozen_llc(config_params, checkpoint, dtype)
+    scripted = script_frozen_llc(frozen_llc)
+
+    # written to a temporary file first, so an interrupted export never leaves a truncated module behind
+    tmp_file = output_file + ".tmp"
+    torch.jit.save(scripted, tmp_file)
+    os.replace(tmp_file, output_file)
+    return scripted
+
+
+def load_frozen_llc(file, device):
+    frozen_llc = torch.jit.load(file, map_location=device)
+    frozen_llc.eval()
+    return frozen_llc
@@ -0,0 +1,177 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import json
+import os
+
+import torch
+
+
+MOTION_ENCODING_VERSION = 1
+MOTION_ENCODING_PREFIX = "motion_encoding_"
+
+
+class MotionEncodingTable:
+    def __init__(self, clip_latents, clip_motion_times, window_latents=None, window_motion_ids=None, window_motion_times=None):
+        # clip_latents holds [num_motions, num_clip_windows, latent_dim] latents of windows spread evenly over
+        # every clip, the optional window tensors cover every encoder window of every clip
+        self.clip_latents = clip_latents
+        self.clip_motion_times = clip_motion_times
+        self.window_latents = window_latents
+        self.window_motion_ids = window_motion_ids
+        self.window_motion_times = window_motion_times
+        return
+
+    def num_clip_windows(self):
+        return self.clip_latents.shape[1]
+
+    def has_windows(self):
+        return self.window_latents is not None
+
+    def to(self, device):
+        tensors = [self.clip_latents, self.clip_motion_times, self.window_latents, self.window_motion_ids, self.window_motion_times]
+        tensors = [t.to(device) if t is not None else None for t in tensors]
+        return MotionEncodingTable(*tensors)
+
+    def save(self, file):
+        data = {
+            "version": MOTION_ENCODING_VERSION,
+            "clip_latents": self.clip_latents.cpu(),
+            "clip_motion_times": self.clip_motion_times.cpu(),
+            "window_latents": self.window_latents.cpu() if self.has_windows() else None,
+            "window_motion_ids": self.window_motion_ids.cpu() if self.has_windows() else None,
+            "window_motion_times": self.window_motion_times.cpu() if self.has_windows() else None,
+        }
+
+        # written to a temporary file first, so an interrupted save never leaves a truncated table behind
+        tmp_file = file + ".tmp"
+        torch.save(data, tmp_file)
+        os.replace(tmp_file, file)
+        return
+
+    @staticmethod
+    def load(file, device):
+        data = torch.load(file, map_location="cpu")
+        if data.get("version") != MOTION_ENCODING_VERSION:
+            raise ValueError("unsupported motion encoding version {}".format(data.get("version")))
+
+        table = MotionEncodingTable(data["clip_latents"], data["clip_motion_times"], data["window_latents"],
+                                    data["window_motion_ids"], data["window_motion_times"])
+        return table.to(device)
+
+
+def encode_amp_obs_demo_windows(task, encode_fn, motion_ids, motion_times, device, chunk_size=4096):
+    # latents of the encoder windows ending at motion_times, computed chunk by chunk in batched passes
+    num_windows = motion_ids.shape[0]
+    latents = None
+    with torch.no_grad():
+        for start in range(0, num_windows, chunk_size):
+            end = min(start + chunk_size, num_windows)
+            enc_amp_obs = task.build_amp_obs_demo(motion_ids[start:end], motion_times[start:end], task._num_amp_obs_enc_steps)
+            enc_amp_obs = enc_amp_obs.to(device).view(end - start, -1)
+            curr_latents = encode_fn(enc_amp_obs)
+
+            if latents is None:
+                latents = torch.zeros((num_windows, curr_latents.shape[-1]), dtype=torch.float32, device=device)
+            latents[start:end] = curr_latents
+
+    return latents
+
+
+def build_motion_encoding_table(task, encode_fn, device, num_clip_windows=1, window_stride=0):
+    num_motions = task._motion_lib.num_motions()
+
+    clip_motion_ids, clip_motion_times = task.get_amp_obs_demo_clip_windows(num_clip_windows)
+    clip_latents = encode_amp_obs_demo_windows(task, encode_fn, clip_motion_ids, clip_motion_times, device)
+    clip_latents = clip_latents.view(num_motions, num_clip_windows, -1)
+    clip_motion_times = clip_motion_times.view(num_motions, num_clip_windows).to(device)
+
+    window_latents = None
+    window_motion_ids = None
+    window_motion_times = None
+    if window_stride > 0:
+        window_motion_ids, window_motion_times = task.get_amp_obs_demo_enc_windows(window_stride)
+        window_latents = encode_amp_obs_demo_windows(task, encode_fn, window_motion_ids, window_motion_times, device)
+        window_motion_ids = window_motion_ids.to(device)
+        window_motion_times = window_motion_times.to(device)
+
+    return MotionEncodingTable(clip_latents, clip_motion_times, window_latents, window_motion_ids, window_motion_times)
+
+
+def get_motion_encoding_cache_file(checkpoint_file, task, num_clip_windows=1, window_stride=0):
+    # the table depends on the encoder weights, the motions, the window layout and the settings that
+    # change how the encoder windows are built
+    hasher = hashlib.sha1()
+    with open(checkpoint_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    hasher.update(task._motion_lib.get_content_hash().encode("utf-8"))
+
+    window_config = {
+        "version": MOTION_ENCODING_VERSION,
+        "dt": float(task.dt),
+        "num_enc_steps": int(task._num_amp_obs_enc_steps),
+        "num_clip_windows": int(num_clip_windows),
+        "window_stride": int(window_stride),
+        "num_amp_obs_per_step": int(task._num_amp_obs_per_step),
+        "local_root_obs": bool(task._local_root_obs),
+        "root_height_obs": bool(task._root_height_obs),
+        "bake_motions": bool(task._bake_motions),
+        "amp_obs_demo_bank": task._amp_obs_demo_bank is not None,
+    }
+    hasher.update(json.dumps(window_config, sort_keys=True).encode("utf-8"))
+
+    cache_dir = os.path.dirname(os.path.abspath(checkpoint_file))
+    return os.path.join(cache_dir, MOTION_ENCODING_PREFIX + hasher.hexdigest() + ".pt")
+
+
+def load_motion_encoding_table(checkpoint_file, task, encode_fn, device, num_clip_windows=1, window_stride=0, use_cache=True):
+    # reloads the table stored next to the LLC checkpoint, building and storing it if there is none
+    cache_file = None
+    if use_cache:
+        cache_file = get_motion_encoding_cache_file(checkpoint_file, task, num_clip_windows, window_stride)
+        if os.path.exists(cache_file):
+            try:
+                table = MotionEncodingTable.load(cache_file, device)
+                print("Loaded cached motion encodings: {:s}".format(cache_file))
+                return table
+            except Exception as e:
+                # the table is only a cache, any unreadable file is rebuilt
+                print("Invalid motion encoding cache {:s}, rebuilding: {}".format(cache_file, e))
+
+    table = build_motion_encoding_table(task, encode_fn, device, num_clip_windows, window_stride)
+
+    if cache_file is not None:
+        try:
+            table.save(cache_file)
+            print("Saved motion encoding cache: {:s}".format(cache_file))
+        except OSError as e:
+            print("Failed to save motion encoding cache {:s}: {}".format(cache_file, e))
+
+    return table
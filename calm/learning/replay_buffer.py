@@ -27,30 +27,50 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import torch
-import numpy as np
 
 
 class ReplayBuffer:
-    def __init__(self, buffer_size, device, numpy_keys=None):
+    def __init__(self, buffer_size, device, host_buffer_size=0, dtype=torch.float32):
+        # buffer_size rows live in a ring on device, rows pushed out of it move to
+        # an optional ring of host_buffer_size rows in pinned host memory.
+        # rows are kept as dtype and returned as float32.
+        # sample draws into output buffers that are reused across calls, with copy=False
+        # the returned tensors are views of those buffers and are overwritten by the next sample
         self._head = 0
+        self._count = 0
         self._total_count = 0
         self._buffer_size = buffer_size
-        self._device = device
+        self._device = torch.device(device)
+        self._dtype = dtype
         self._data_buf = None
-        self._sample_idx = torch.randperm(buffer_size)
+        self._sample_idx = torch.randperm(buffer_size, device=self._device)
         self._sample_head = 0
-        self._numpy_keys = numpy_keys
+        self._sample_buf = None
+
+        self._host_buffer_size = host_buffer_size
+        self._host_head = 0
+        self._host_count = 0
+        self._host_data_buf = None
+        self._pin_memory = self._device.type == "cuda"
+        self._host_staging_buf = None
+        self._host_prefetch_buf = None
+        self._host_prefetch_n = 0
+        self._host_copy_event = None
 
         return
 
     def reset(self):
         self._head = 0
+        self._count = 0
         self._total_count = 0
+        self._host_head = 0
+        self._host_count = 0
+        self._host_prefetch_n = 0
         self._reset_sample_idx()
         return
 
     def get_buffer_size(self):
-        return self._buffer_size
+        return self._buffer_size + self._host_buffer_size
 
     def get_total_count(self):
         return self._total_count
@@ -60,60 +80,266 @@ class ReplayBuffer:
             self._init_data_buf(data_dict)
 
         n = next(iter(data_dict.values())).shape[0]
-        buffer_size = self.get_buffer_size()
-        assert(n <= buffer_size)
+        assert(n <= self.get_buffer_size())
 
-        for key, curr_buf in self._data_buf.items():
-            curr_n = data_dict[key].shape[0]
-            assert(n == curr_n)
+        # rows that do not fit in the device ring go straight to the host tier
+        overflow_n = n - self._buffer_size
+        if overflow_n > 0:
+            self._store_host({k: v[:overflow_n] for k, v in data_dict.items()})
+            data_dict = {k: v[overflow_n:] for k, v in data_dict.items()}
+            n = self._buffer_size
 
-            store_n = min(curr_n, buffer_size - self._head)
-            curr_buf[self._head:(self._head + store_n)] = data_dict[key][:store_n]    
-        
-            remainder = n - store_n
-            if remainder > 0:
-                curr_buf[0:remainder] = data_dict[key][store_n:]  
+        store_idx = torch.arange(self._head, self._head + n, dtype=torch.long, device=self._device)
+        store_idx.remainder_(self._buffer_size)
 
-        self._head = (self._head + n) % buffer_size
-        self._total_count += n
+        evict_n = self._count + n - self._buffer_size
+        if evict_n > 0 and self._host_buffer_size > 0:
+            evict_idx = store_idx[(n - evict_n):]
+            self._store_host({k: v[evict_idx] for k, v in self._data_buf.items()})
+
+        for key, curr_buf in self._data_buf.items():
+            curr_data = data_dict[key]
+            assert(curr_data.shape[0] == n)
+            curr_buf.index_copy_(0, store_idx, curr_data.to(device=curr_buf.device, dtype=curr_buf.dtype))
+
+        self._head = (self._head + n) % self._buffer_size
+        self._count = min(self._count + n, self._buffer_size)
+        self._total_count += n + max(overflow_n, 0)
 
         return
 
-    def sample(self, n):
-        total_count = self.get_total_count()
-        buffer_size = self.get_buffer_size()
+    def sample(self, n, copy=True):
+        # with copy=False the returned tensors are views of output buffers that are reused by the next call,
+        # callers must be done with them before sampling again
+        host_n = 0
+        if self._host_count > 0:
+            host_n = int(round(n * self._host_count / (self._count + self._host_count)))
+        device_n = n - host_n
 
-        idx = torch.arange(self._sample_head, self._sample_head + n)
-        idx = idx % buffer_size
-        rand_idx = self._sample_idx[idx]
-        if total_count < buffer_size:
-            rand_idx = rand_idx % self._head
+        samples = self._get_sample_buf(n)
 
-        samples = dict()
-        for k, v in self._data_buf.items():
-            samples[k] = v[rand_idx]
+        if device_n > 0:
+            rand_idx = self._next_sample_idx(device_n)
+            for k, v in self._data_buf.items():
+                self._gather(v, rand_idx, samples[k][:device_n])
+
+        if host_n > 0:
+            if self._host_prefetch_n != host_n:
+                self._prefetch_host(host_n)
+            for k, v in self._host_prefetch_buf.items():
+                samples[k][device_n:].copy_(v[:host_n])
+            self._prefetch_host(host_n)
+
+        if copy:
+            samples = {k: v.clone() for k, v in samples.items()}
+
+        return samples
+
+    def _next_sample_idx(self, n):
+        if self._sample_head + n <= self._buffer_size:
+            rand_idx = self._sample_idx[self._sample_head:(self._sample_head + n)]
+        else:
+            idx = torch.arange(self._sample_head, self._sample_head + n, device=self._device)
+            rand_idx = self._sample_idx[idx % self._buffer_size]
+
+        if self._count < self._buffer_size:
+            rand_idx = rand_idx % self._count
 
         self._sample_head += n
-        if self._sample_head >= buffer_size:
+        if self._sample_head >= self._buffer_size:
             self._reset_sample_idx()
 
-        return samples
+        return rand_idx
 
     def _reset_sample_idx(self):
-        buffer_size = self.get_buffer_size()
-        self._sample_idx[:] = torch.randperm(buffer_size)
+        buffer_size = self._buffer_size
+        self._sample_idx[:] = torch.randperm(buffer_size, device=self._device)
         self._sample_head = 0
         return
 
+    def get_num_bytes(self, row_numel=None):
+        # bytes of the device and host rows. the storage is only allocated by the first store,
+        # before that row_numel gives the number of elements of a row
+        if self._data_buf is not None:
+            row_numel = sum([v[0].numel() for v in self._data_buf.values()])
+        assert(row_numel is not None)
+        element_size = torch.zeros(0, dtype=self._dtype).element_size()
+        return self.get_buffer_size() * row_numel * element_size
+
+    def _get_sample_buf(self, n):
+        sample_n = next(iter(self._sample_buf.values())).shape[0]
+        if sample_n < n:
+            self._sample_buf = {k: torch.zeros((n,) + v.shape[1:], dtype=torch.float32, device=self._device)
+                                for k, v in self._data_buf.items()}
+        return {k: v[:n] for k, v in self._sample_buf.items()}
+
+    def _gather(self, data_buf, idx, out):
+        if data_buf.dtype == out.dtype:
+            torch.index_select(data_buf, 0, idx, out=out)
+        else:
+            out.copy_(data_buf[idx])
+        return
+
+    def _store_host(self, data_dict):
+        n = next(iter(data_dict.values())).shape[0]
+        n = min(n, self._host_buffer_size)
+        start = self._host_head
+        store_n = min(n, self._host_buffer_size - start)
+        remainder = n - store_n
+
+        # the device to host copies run asynchronously, reads of the host tier wait on this event
+        for k, host_buf in self._host_data_buf.items():
+            curr_data = data_dict[k][-n:]
+            host_buf[start:(start + store_n)].copy_(curr_data[:store_n], non_blocking=self._pin_memory)
+            if remainder > 0:
+                host_buf[0:remainder].copy_(curr_data[store_n:], non_blocking=self._pin_memory)
+        self._record_host_copy()
+
+        self._host_head = (self._host_head + n) % self._host_buffer_size
+        self._host_count = min(self._host_count + n, self._host_buffer_size)
+        return
+
+    def _prefetch_host(self, n):
+        # gather the host rows for the next sample call and start their upload to the device
+        if self._host_staging_buf is None or next(iter(self._host_staging_buf.values())).shape[0] < n:
+            self._wait_host_copy()
+            self._host_staging_buf = {k: torch.zeros((n,) + v.shape[1:], dtype=v.dtype, pin_memory=self._pin_memory)
+                                      for k, v in self._host_data_buf.items()}
+            self._host_prefetch_buf = {k: torch.zeros((n,) + v.shape[1:], dtype=v.dtype, device=self._device)
+                                       for k, v in self._host_data_buf.items()}
+
+        self._wait_host_copy()
+        host_idx = torch.randint(0, self._host_count, (n,), dtype=torch.long)
+        for k, host_buf in self._host_data_buf.items():
+            staging_buf = self._host_staging_buf[k][:n]
+            torch.index_select(host_buf, 0, host_idx, out=staging_buf)
+            self._host_prefetch_buf[k][:n].copy_(staging_buf, non_blocking=self._pin_memory)
+        self._record_host_copy()
+
+        self._host_prefetch_n = n
+        return
+
+    def _record_host_copy(self):
+        if self._pin_memory:
+            self._host_copy_event = torch.cuda.Event()
+            self._host_copy_event.record()
+        return
+
+    def _wait_host_copy(self):
+        if self._host_copy_event is not None:
+            self._host_copy_event.synchronize()
+            self._host_copy_event = None
+        return
+
     def _init_data_buf(self, data_dict):
-        buffer_size = self.get_buffer_size()
+        buffer_size = self._buffer_size
         self._data_buf = dict()
+        self._sample_buf = dict()
 
         for k, v in data_dict.items():
             v_shape = v.shape[1:]
-            if self._numpy_keys is not None and k in self._numpy_keys:
-                self._data_buf[k] = np.zeros((buffer_size,) + v_shape, dtype=np.float32)
-            else:
-                self._data_buf[k] = torch.zeros((buffer_size,) + v_shape, device=self._device)
+            self._data_buf[k] = torch.zeros((buffer_size,) + v_shape, dtype=self._dtype, device=self._device)
+            self._sample_buf[k] = torch.zeros((0,) + v_shape, dtype=torch.float32, device=self._device)
+
+        if self._host_buffer_size > 0:
+            self._host_data_buf = dict()
+            for k, v in data_dict.items():
+                v_shape = v.shape[1:]
+                self._host_data_buf[k] = torch.zeros((self._host_buffer_size,) + v_shape, dtype=self._dtype,
+                                                     pin_memory=self._pin_memory)
+
+        return
+
+
+class SumTree:
+    def __init__(self, size, device):
+        # complete binary tree stored in an array, node i has children 2i and 2i+1 and the leaves start at _capacity
+        self._capacity = 1
+        while self._capacity < size:
+            self._capacity *= 2
+        self._depth = self._capacity.bit_length() - 1
+        self._device = device
+        self._tree = torch.zeros(2 * self._capacity, dtype=torch.float32, device=device)
+        return
+
+    def reset(self):
+        self._tree[:] = 0
+        return
+
+    def total(self):
+        return self._tree[1]
+
+    def get(self, idx):
+        return self._tree[idx + self._capacity]
+
+    def update(self, idx, values):
+        node_idx = idx + self._capacity
+        self._tree[node_idx] = values
+        for _ in range(self._depth):
+            node_idx = node_idx // 2
+            self._tree[node_idx] = self._tree[2 * node_idx] + self._tree[2 * node_idx + 1]
+        return
+
+    def find(self, values):
+        # index of the leaf whose cumulative range contains each value, one level per step for the whole batch
+        node_idx = torch.ones_like(values, dtype=torch.long)
+        for _ in range(self._depth):
+            left_idx = 2 * node_idx
+            left_values = self._tree[left_idx]
+            go_right = values > left_values
+            values = torch.where(go_right, values - left_values, values)
+            node_idx = left_idx + go_right.long()
+        return node_idx - self._capacity
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self, buffer_size, device, alpha=0.6, eps=1e-3, dtype=torch.float32):
+        # entries are sampled with probability proportional to (priority + eps)^alpha,
+        # new entries get the largest priority seen so far so they are drawn at least once
+        super().__init__(buffer_size, device, dtype=dtype)
+        self._alpha = alpha
+        self._eps = eps
+        self._sum_tree = SumTree(buffer_size, self._device)
+        self._max_priority = torch.ones(1, dtype=torch.float32, device=self._device)
+        return
+
+    def reset(self):
+        super().reset()
+        self._sum_tree.reset()
+        self._max_priority[:] = 1.0
+        return
+
+    def store(self, data_dict):
+        n = next(iter(data_dict.values())).shape[0]
+        assert(n <= self._buffer_size)
+        store_idx = torch.arange(self._head, self._head + n, dtype=torch.long, device=self._device)
+        store_idx.remainder_(self._buffer_size)
+
+        super().store(data_dict)
+        self._sum_tree.update(store_idx, self._max_priority.expand(n))
+        return
+
+    def sample(self, n, copy=True):
+        # stratified draws, one per equal slice of the total priority mass
+        samples = self._get_sample_buf(n)
+
+        total = self._sum_tree.total()
+        u = torch.arange(n, dtype=torch.float32, device=self._device)
+        u += torch.rand(n, device=self._device)
+        u *= total / n
+        rand_idx = self._sum_tree.find(u)
+        rand_idx = torch.clamp(rand_idx, max=self._count - 1)
+
+        for k, v in self._data_buf.items():
+            self._gather(v, rand_idx, samples[k])
+        if copy:
+            samples = {k: v.clone() for k, v in samples.items()}
+        samples['idx'] = rand_idx
+
+        return samples
 
+    def update_priorities(self, idx, priorities):
+        priorities = torch.pow(priorities.float() + self._eps, self._alpha)
+        self._sum_tree.update(idx, priorities)
+        torch.maximum(self._max_priority, torch.max(priorities), out=self._max_priority)
         return
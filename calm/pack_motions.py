@@ -0,0 +1,82 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import os
+
+from utils.motion_lib import MotionLib
+from utils import motion_pack
+
+"""
+Converts a motion dataset (a .yaml motion list or a single .npy clip) into a packed motion
+file that can be passed as --motion_file in place of the original dataset, e.g.
+
+python calm/pack_motions.py --motion_file calm/data/motions/reallusion_sword_shield/dataset_reallusion_sword_shield.yaml
+"""
+
+# dof configs of the supported characters, same as in Humanoid._setup_character_props
+DOF_CONFIGS = {
+    "mjcf/amp_humanoid.xml": {
+        "dof_body_ids": [1, 2, 3, 4, 6, 7, 9, 10, 11, 12, 13, 14],
+        "dof_offsets": [0, 3, 6, 9, 10, 13, 14, 17, 18, 21, 24, 25, 28],
+    },
+    "mjcf/amp_humanoid_sword_shield.xml": {
+        "dof_body_ids": [1, 2, 3, 4, 5, 7, 8, 11, 12, 13, 14, 15, 16],
+        "dof_offsets": [0, 3, 6, 9, 10, 13, 16, 17, 20, 21, 24, 27, 28, 31],
+    },
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a motion dataset into a single memory mappable file")
+    parser.add_argument("--motion_file", type=str, required=True,
+                        help="Motion dataset to pack, either a .yaml motion list or a single .npy clip")
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the packed file, defaults to the motion file with the {:s} extension".format(motion_pack.MOTION_PACK_EXT))
+    parser.add_argument("--asset_file", type=str, default="mjcf/amp_humanoid_sword_shield.xml",
+                        choices=list(DOF_CONFIGS.keys()),
+                        help="Character asset, used to compute the dof velocities")
+    args = parser.parse_args()
+
+    output = args.output
+    if (output == ""):
+        output = os.path.splitext(args.motion_file)[0] + motion_pack.MOTION_PACK_EXT
+
+    dof_config = DOF_CONFIGS[args.asset_file]
+    motion_lib = MotionLib(motion_file=args.motion_file,
+                           dof_body_ids=dof_config["dof_body_ids"],
+                           dof_offsets=dof_config["dof_offsets"],
+                           key_body_ids=[],
+                           equal_motion_weights=False,
+                           device="cpu")
+
+    motion_lib.save_motion_pack(output)
+    print("Saved {:d} motions to {:s}".format(motion_lib.num_motions(), output))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import pytest
+
+# isaacgym has to be imported before torch
+pytest.importorskip("isaacgym")
+
+import torch
+
+from env.tasks.humanoid_amp import HumanoidAMP, build_amp_observations, build_amp_observations_from_frames
+from utils.motion_lib import MotionLib
+
+from tests.conftest import CALM_DIR
+
+# amp_humanoid.xml, see Humanoid._setup_character_props
+DOF_BODY_IDS = [1, 2, 3, 4, 6, 7, 9, 10, 11, 12, 13, 14]
+DOF_OFFSETS = [0, 3, 6, 9, 10, 13, 14, 17, 18, 21, 24, 25, 28]
+DOF_OBS_SIZE = 72
+KEY_BODY_IDS = [5, 8, 11, 14]
+MOTION_FILE = os.path.join(CALM_DIR, "data/motions/amp_humanoid_run.npy")
+
+
+def _build_task(motion_lib):
+    # only the attributes used by _compute_amp_obs_demo
+    task = HumanoidAMP.__new__(HumanoidAMP)
+    task.device = "cpu"
+    task._dof_offsets = DOF_OFFSETS
+    task._dof_obs_size = DOF_OBS_SIZE
+    task.num_dof = DOF_OFFSETS[-1]
+    task._motion_lib = motion_lib
+    task._bake_motions = True
+    task._build_demo_dof_index()
+    return task
+
+
+def _sample_motion_times(motion_lib, n):
+    torch.manual_seed(0)
+    motion_ids = motion_lib.sample_motions(n)
+    motion_times = motion_lib.sample_time(motion_ids)
+    return motion_ids, motion_times
+
+
+@pytest.mark.parametrize("local_root_obs", [True, False])
+def test_fused_demo_obs_matches_build_amp_observations(local_root_obs):
+    motion_lib = MotionLib(motion_file=MOTION_FILE, dof_body_ids=DOF_BODY_IDS, dof_offsets=DOF_OFFSETS,
+                           key_body_ids=KEY_BODY_IDS, equal_motion_weights=False, device="cpu", baked=True)
+    task = _build_task(motion_lib)
+    motion_ids, motion_times = _sample_motion_times(motion_lib, 4096)
+
+    frames, blend = motion_lib.get_baked_frames(motion_ids, motion_times)
+    fused_obs = build_amp_observations_from_frames(frames, blend, motion_lib.get_baked_pose_size(), task.num_dof,
+                                                   local_root_obs, True, task._demo_dof3_cols, task._demo_dof1_cols,
+                                                   task._demo_dof_obs_perm)
+
+    root_pos, root_rot, dof_pos, root_vel, root_ang_vel, dof_vel, key_pos = motion_lib.get_motion_state(motion_ids, motion_times)
+    ref_obs = build_amp_observations(root_pos, root_rot, root_vel, root_ang_vel, dof_pos, dof_vel, key_pos,
+                                     local_root_obs, True, DOF_OBS_SIZE, DOF_OFFSETS)
+
+    assert fused_obs.shape == ref_obs.shape
+    assert torch.allclose(fused_obs, ref_obs, rtol=0.0, atol=1e-5), (fused_obs - ref_obs).abs().max()
+
@@ -0,0 +1,85 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import time
+
+import pytest
+
+# isaacgym has to be imported before torch
+pytest.importorskip("isaacgym")
+
+import torch
+
+from utils.motion_lib import MotionLib
+
+from tests.conftest import CALM_DIR
+
+# amp_humanoid.xml, see Humanoid._setup_character_props
+DOF_BODY_IDS = [1, 2, 3, 4, 6, 7, 9, 10, 11, 12, 13, 14]
+DOF_OFFSETS = [0, 3, 6, 9, 10, 13, 14, 17, 18, 21, 24, 25, 28]
+KEY_BODY_IDS = [5, 8, 11, 14]
+MOTION_FILES = ["amp_humanoid_walk.npy", "amp_humanoid_jog.npy", "amp_humanoid_run.npy"]
+
+
+def _write_motion_list(tmp_path):
+    motion_list = os.path.join(str(tmp_path), "motions.yaml")
+    with open(motion_list, "w") as f:
+        f.write("motions:\n")
+        for motion_file in MOTION_FILES:
+            f.write("  - file: \"{:s}\"\n".format(os.path.join(CALM_DIR, "data/motions", motion_file)))
+            f.write("    weight: 1.0\n")
+    return motion_list
+
+
+def _load(motion_file, num_workers):
+    start = time.time()
+    motion_lib = MotionLib(motion_file=motion_file, dof_body_ids=DOF_BODY_IDS, dof_offsets=DOF_OFFSETS,
+                           key_body_ids=KEY_BODY_IDS, equal_motion_weights=False, device="cpu",
+                           num_workers=num_workers)
+    return motion_lib, time.time() - start
+
+
+def test_parallel_load_matches_serial_load(tmp_path):
+    motion_list = _write_motion_list(tmp_path)
+    serial_lib, serial_time = _load(motion_list, 0)
+    parallel_lib, parallel_time = _load(motion_list, 2)
+
+    assert serial_lib.motion_files == parallel_lib.motion_files
+    for k in MotionLib.MOTION_ARRAYS + ("length_starts",):
+        assert torch.equal(getattr(serial_lib, k), getattr(parallel_lib, k)), k
+
+    for k in ["motion_lengths", "motion_weights", "motion_fps", "motion_dt", "motion_num_frames"]:
+        assert torch.equal(getattr(serial_lib.state, k), getattr(parallel_lib.state, k)), k
+
+    for serial_motion, parallel_motion in zip(serial_lib.state.motions, parallel_lib.state.motions):
+        assert torch.equal(serial_motion.global_translation, parallel_motion.global_translation)
+        assert torch.equal(serial_motion.dof_vels, parallel_motion.dof_vels)
+
+    # worker start-up dominates for small datasets, the pool only pays off with many clips on a multi-core host
+    print("{:d} clips: serial {:.2f}s, 2 workers {:.2f}s".format(len(MOTION_FILES), serial_time, parallel_time))
@@ -0,0 +1,150 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import numpy as np
+import torch
+
+
+class AliasSampler:
+    """
+    Weighted sampling with replacement using Vose's alias method, O(1) per sample.
+
+    Items are split into blocks of block_size, with one alias table over the block weights and
+    one alias table per block. Sampling draws a block and then an item within the block, so
+    updating the weights of a few items only rebuilds the tables of their blocks and the
+    table over the blocks.
+    """
+
+    def __init__(self, weights, block_size=256, device="cpu"):
+        self._device = device
+
+        weights = to_numpy(weights, np.float64)
+        assert(np.all(weights >= 0))
+        self._num_items = weights.shape[0]
+        self._block_size = min(block_size, self._num_items)
+        self._num_blocks = (self._num_items + self._block_size - 1) // self._block_size
+
+        self._weights = np.zeros(self._num_blocks * self._block_size, dtype=np.float64)
+        self._weights[:self._num_items] = weights
+
+        block_weights = self._weights.reshape(self._num_blocks, self._block_size)
+        prob = np.ones((self._num_blocks, self._block_size), dtype=np.float32)
+        alias = np.zeros((self._num_blocks, self._block_size), dtype=np.int64)
+        for b in range(self._num_blocks):
+            prob[b], alias[b] = build_alias_table(block_weights[b])
+
+        self._prob = torch.tensor(prob, device=self._device)
+        self._alias = torch.tensor(alias, device=self._device)
+        self._block_prob = None
+        self._block_alias = None
+        self._build_block_table()
+        return
+
+    def sample(self, n):
+        rand = torch.rand((4, n), device=self._device)
+
+        block = torch.clamp_max((rand[0] * self._num_blocks).long(), self._num_blocks - 1)
+        block = torch.where(rand[1] < self._block_prob[block], block, self._block_alias[block])
+
+        item = torch.clamp_max((rand[2] * self._block_size).long(), self._block_size - 1)
+        item = torch.where(rand[3] < self._prob[block, item], item, self._alias[block, item])
+
+        return block * self._block_size + item
+
+    def update(self, ids, weights):
+        ids = to_numpy(ids, np.int64).reshape(-1)
+        weights = to_numpy(weights, np.float64).reshape(-1)
+        weights = np.broadcast_to(weights, ids.shape)
+        assert(np.all(weights >= 0))
+
+        self._weights[ids] = weights
+
+        blocks = np.unique(ids // self._block_size)
+        block_weights = self._weights.reshape(self._num_blocks, self._block_size)
+        prob = np.ones((blocks.shape[0], self._block_size), dtype=np.float32)
+        alias = np.zeros((blocks.shape[0], self._block_size), dtype=np.int64)
+        for i, b in enumerate(blocks):
+            prob[i], alias[i] = build_alias_table(block_weights[b])
+
+        blocks = torch.tensor(blocks, device=self._device)
+        self._prob[blocks] = torch.tensor(prob, device=self._device)
+        self._alias[blocks] = torch.tensor(alias, device=self._device)
+        self._build_block_table()
+        return
+
+    def get_weights(self):
+        return self._weights[:self._num_items]
+
+    def _build_block_table(self):
+        block_weights = self._weights.reshape(self._num_blocks, self._block_size).sum(axis=-1)
+        assert(block_weights.sum() > 0), "At least one item needs a positive weight"
+
+        prob, alias = build_alias_table(block_weights)
+        self._block_prob = torch.tensor(prob, device=self._device)
+        self._block_alias = torch.tensor(alias, device=self._device)
+        return
+
+
+def to_numpy(x, dtype):
+    if torch.is_tensor(x):
+        x = x.cpu().numpy()
+    return np.array(x, dtype=dtype)
+
+def build_alias_table(weights):
+    n = weights.shape[0]
+    prob = np.ones(n, dtype=np.float32)
+    alias = np.arange(n, dtype=np.int64)
+
+    total = weights.sum()
+    if (total <= 0):
+        # never drawn, the table over the blocks gives this block a weight of zero
+        return prob, alias
+
+    scaled = weights * (n / total)
+    # the smallest weights are popped first, so that zero weights are never left over
+    small = np.nonzero(scaled < 1.0)[0]
+    small = list(small[np.argsort(-scaled[small], kind="stable")])
+    large = list(np.nonzero(scaled >= 1.0)[0])
+    while (len(small) > 0 and len(large) > 0):
+        s = small.pop()
+        l = large.pop()
+
+        prob[s] = scaled[s]
+        alias[s] = l
+
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if (scaled[l] < 1.0):
+            small.append(l)
+        else:
+            large.append(l)
+
+    # whatever is left is only off from 1 by rounding errors
+    for i in large + small:
+        prob[i] = 1.0
+
+    return prob, alias
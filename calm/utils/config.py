@@ -132,6 +132,9 @@ def load_cfg(args):
     if args.llc_checkpoint != "":
         cfg_train["params"]["config"]["llc_checkpoint"] = args.llc_checkpoint
 
+    if args.llc_frozen_checkpoint != "":
+        cfg_train["params"]["config"]["llc_frozen_checkpoint"] = args.llc_frozen_checkpoint
+
     if args.llc_config != "":
         cfg_train["params"]["config"]["llc_config"] = args.llc_config
 
@@ -243,6 +246,8 @@ def get_args(benchmark=False):
         {"name": "--output_path", "type": str, "default": "output/", "help": "Specify output directory"},
         {"name": "--llc_checkpoint", "type": str, "default": "",
             "help": "Path to the saved weights for the low-level controller of an HRL agent."},
+        {"name": "--llc_frozen_checkpoint", "type": str, "default": "",
+            "help": "Path to a low-level controller exported with export_llc.py, used in place of --llc_checkpoint."},
         {"name": "--llc_config", "type": str, "default": "",
          "help": "Path to the config for the low-level controller of an HRL agent."},
         {"name": "--llc_steps", "type": int, "default": -1,
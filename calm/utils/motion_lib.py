@@ -26,14 +26,22 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
+import json
+import multiprocessing
 import numpy as np
 import os
+import time
 import yaml
 
 from poselib.poselib.skeleton.skeleton3d import SkeletonMotion
 from poselib.poselib.core.rotation3d import *
 from isaacgym.torch_utils import *
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from utils import motion_pack
+from utils import alias_sampler
+from utils.alias_sampler import AliasSampler
 from utils import torch_utils
 from utils.device_dtype_mixin import DeviceDtypeModuleMixin
 from torch import nn
@@ -58,42 +66,83 @@ if not USE_CACHE:
 
 
 class DeviceCache:
+    """
+    Device copies of the clip properties consumed by MotionLib. A property is only evaluated and
+    copied to the device when it is first accessed, all other attributes are forwarded to the clip.
+    """
+
+    CACHED_KEYS = (
+        "global_translation",
+        "global_rotation",
+        "local_rotation",
+        "global_root_velocity",
+        "global_root_angular_velocity",
+        "dof_vels",
+    )
+
     def __init__(self, obj, device):
         self.obj = obj
         self.device = device
+        self._cache = dict()
+        self.num_bytes = 0
+        self.load_time = 0.0
 
-        keys = dir(obj)
-        num_added = 0
+    def materialize(self, keys=CACHED_KEYS):
         for k in keys:
-            try:
-                out = getattr(obj, k)
-            except:
-                print("Error for key=", k)
-                continue
-
-            if isinstance(out, torch.Tensor):
-                if out.is_floating_point():
-                    out = out.to(self.device, dtype=torch.float32)
-                else:
-                    out.to(self.device)
-                setattr(self, k, out)  
-                num_added += 1
-            elif isinstance(out, np.ndarray):
-                out = torch.tensor(out)
-                if out.is_floating_point():
-                    out = out.to(self.device, dtype=torch.float32)
-                else:
-                    out.to(self.device)
-                setattr(self, k, out)
-                num_added += 1
-        
-        print("Total added", num_added)
+            getattr(self, k)
+        return self
+
+    def to(self, device):
+        # moves the cached tensors, used for caches that were built by the loader worker processes
+        self.device = device
+        for k, out in self._cache.items():
+            self._cache[k] = out.to(self.device, dtype=torch.float32)
+        return self
+
+    def release(self):
+        # drops the device copies, they are evaluated again if accessed later
+        self._cache.clear()
+        return
+
+    def get_skipped_keys(self):
+        skipped_keys = [k for k in dir(type(self.obj))
+                        if isinstance(getattr(type(self.obj), k), property) and k not in self.CACHED_KEYS]
+        return skipped_keys
 
     def __getattr__(self, string):
+        if (string in ("obj", "_cache")):
+            # not set yet while unpickling
+            raise AttributeError(string)
+
+        if (string in self.CACHED_KEYS):
+            out = self._cache.get(string)
+            if out is None:
+                start_time = time.time()
+                out = getattr(self.obj, string)
+                if isinstance(out, np.ndarray):
+                    out = torch.tensor(out)
+                out = out.to(self.device, dtype=torch.float32)
+                self._cache[string] = out
+                self.num_bytes += out.numel() * out.element_size()
+                self.load_time += time.time() - start_time
+            return out
+
         out = getattr(self.obj, string)
         return out
 
 
+def _init_motion_load_worker():
+    torch.set_num_threads(1)
+    return
+
+def _load_motion_file(motion_file):
+    # runs in the loader worker processes, evaluates the forward kinematics of a clip on the cpu
+    curr_motion = SkeletonMotion.from_file(motion_file)
+    # dof_vels are added by the main process
+    keys = [k for k in DeviceCache.CACHED_KEYS if k != "dof_vels"]
+    return DeviceCache(curr_motion, "cpu").materialize(keys)
+
+
 class LoadedMotions(nn.Module):
     """
     Tuples here needed so the class can hash, which is
@@ -130,6 +179,8 @@ class LoadedMotions(nn.Module):
 
 
 class MotionLib(DeviceDtypeModuleMixin):
+    MOTION_ARRAYS = ("gts", "grs", "lrs", "grvs", "gravs", "dvs")
+
     gts: Tensor
     grs: Tensor
     lrs: Tensor
@@ -148,6 +199,12 @@ class MotionLib(DeviceDtypeModuleMixin):
         key_body_ids,
         equal_motion_weights,
         device="cpu",
+        baked=False,
+        cache_dir=None,
+        num_workers=0,
+        shard_frames=0,
+        resident_shards=4,
+        shard_swap_interval=100,
     ):
         super().__init__()
 
@@ -162,86 +219,169 @@ class MotionLib(DeviceDtypeModuleMixin):
         )
 
         self._key_body_ids = torch.tensor(key_body_ids, device=device)
+        self._build_dof_index(dof_body_ids, dof_offsets)
         self._device = device
         self._equal_motion_weights = equal_motion_weights
-        self.motion_files = self._load_motions(motion_file)
+        self._baked = baked
+        self._num_workers = num_workers
+        self._sharded = shard_frames > 0
+        self._motion_sampler = None
+        self._key_body_id_list = [int(i) for i in key_body_ids]
+        self._motion_file = motion_file
+        self._content_hash = None
+
+        cache_file = None
+        motion_arrays = None
+        if motion_pack.is_motion_pack(motion_file):
+            self.motion_files, motion_arrays = self._load_motion_pack(motion_file)
+        elif cache_dir:
+            cache_file = os.path.join(cache_dir, self.get_content_hash() + motion_pack.MOTION_PACK_EXT)
+            if os.path.exists(cache_file):
+                try:
+                    print("Loading cached motions: {:s}".format(cache_file))
+                    self.motion_files, motion_arrays = self._load_motion_pack(cache_file)
+                    cache_file = None
+                except (ValueError, KeyError, OSError) as e:
+                    print("Invalid motion cache {:s}, rebuilding: {}".format(cache_file, e))
+                    motion_arrays = None
+
+        if motion_arrays is None:
+            self.motion_files = self._load_motions(motion_file)
+
+            motions = self.state.motions
+            motion_arrays = {
+                "gts": torch.cat([m.global_translation for m in motions], dim=0),
+                "grs": torch.cat([m.global_rotation for m in motions], dim=0),
+                "lrs": torch.cat([m.local_rotation for m in motions], dim=0),
+                "grvs": torch.cat([m.global_root_velocity for m in motions], dim=0),
+                "gravs": torch.cat([m.global_root_angular_velocity for m in motions], dim=0),
+                "dvs": torch.cat([m.dof_vels for m in motions], dim=0),
+            }
 
-        motions = self.state.motions
-        self.register_buffer(
-            "gts",
-            torch.cat([m.global_translation for m in motions], dim=0).to(
-                dtype=torch.float32
-            ),
-            persistent=False,
-        )
-        self.register_buffer(
-            "grs",
-            torch.cat([m.global_rotation for m in motions], dim=0).to(
-                dtype=torch.float32
-            ),
-            persistent=False,
-        )
-        self.register_buffer(
-            "lrs",
-            torch.cat([m.local_rotation for m in motions], dim=0).to(
-                dtype=torch.float32
-            ),
-            persistent=False,
-        )
-        self.register_buffer(
-            "grvs",
-            torch.cat([m.global_root_velocity for m in motions], dim=0).to(
-                dtype=torch.float32
-            ),
-            persistent=False,
-        )
-        self.register_buffer(
-            "gravs",
-            torch.cat([m.global_root_angular_velocity for m in motions], dim=0).to(
-                dtype=torch.float32
-            ),
-            persistent=False,
-        )
-        self.register_buffer(
-            "dvs",
-            torch.cat([m.dof_vels for m in motions], dim=0).to(
-                device=device, dtype=torch.float32
-            ),
-            persistent=False,
-        )
+            if USE_CACHE:
+                self._release_motion_caches(motions)
 
         lengths = self.state.motion_num_frames
         lengths_shifted = lengths.roll(1)
         lengths_shifted[0] = 0
-        self.register_buffer(
-            "length_starts", lengths_shifted.cumsum(0), persistent=False
-        )
+
+        if self._sharded:
+            self._init_shards(motion_arrays, lengths_shifted.cumsum(0), shard_frames, resident_shards, shard_swap_interval)
+        else:
+            for k in self.MOTION_ARRAYS:
+                self.register_buffer(
+                    k,
+                    motion_arrays[k].to(device=device, dtype=torch.float32),
+                    persistent=False,
+                )
+
+            self.register_buffer(
+                "length_starts", lengths_shifted.cumsum(0), persistent=False
+            )
 
         self.register_buffer(
             "motion_ids",
             torch.arange(
-                len(self.state.motions), dtype=torch.long, device=self._device
+                self.num_motions(), dtype=torch.long, device=self._device
             ),
             persistent=False,
         )
 
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.save_motion_pack(cache_file)
+            print("Saved motion cache: {:s}".format(cache_file))
+
         self.to(device)
 
+        self._raw_motion_weights = self.state.motion_weights.cpu().numpy().astype(np.float64)
+        if self._sharded:
+            self._fill_shards()
+            self._motion_sampler = AliasSampler(self._resident_motion_weights, device=self._device)
+        else:
+            self._motion_sampler = AliasSampler(self.state.motion_weights, device=self._device)
+
+        if self._baked and not self._sharded:
+            self.register_buffer(
+                "baked_frames",
+                self._bake_motion_frames(self.gts, self.grs, self.lrs, self.grvs, self.gravs, self.dvs,
+                                         self.length_starts, self.state.motion_num_frames),
+                persistent=False,
+            )
+
     def num_motions(self):
-        return len(self.state.motions)
+        return self.state.motion_num_frames.shape[0]
 
     def get_total_length(self):
         return sum(self.state.motion_lengths)
 
+    def get_content_hash(self):
+        """
+        Hash of everything the processed motion buffers depend on: the bytes and weights of all
+        motion files, the skeleton config and the motion pack version.
+        """
+        if self._content_hash is None:
+            hasher = hashlib.sha1()
+            hasher.update(str(motion_pack.MOTION_PACK_VERSION).encode("utf-8"))
+
+            if motion_pack.is_motion_pack(self._motion_file):
+                motion_files = [self._motion_file]
+                motion_weights = [1.0]
+            else:
+                motion_files, motion_weights = self._fetch_motion_files(self._motion_file)
+
+            for curr_file, curr_weight in zip(motion_files, motion_weights):
+                with open(curr_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        hasher.update(chunk)
+                hasher.update(repr(float(curr_weight)).encode("utf-8"))
+
+            skeleton_config = {
+                "dof_body_ids": [int(i) for i in self._dof_body_ids],
+                "dof_offsets": [int(i) for i in self._dof_offsets],
+                "key_body_ids": self._key_body_id_list,
+                "equal_motion_weights": bool(self._equal_motion_weights),
+            }
+            hasher.update(json.dumps(skeleton_config, sort_keys=True).encode("utf-8"))
+
+            self._content_hash = hasher.hexdigest()
+
+        return self._content_hash
+
     def get_motion(self, motion_id):
+        if len(self.state.motions) == 0:
+            raise RuntimeError("Skeleton motion clips are not kept when the motions are loaded from a motion pack or "
+                               "the motion cache, get_motion needs the original motion files loaded without motion_cache_dir")
         return self.state.motions[motion_id]
 
     def sample_motions(self, n):
-        motion_ids = torch.multinomial(
-            self.state.motion_weights, num_samples=n, replacement=True
-        )
+        if self._sharded:
+            # only resident clips are sampled, the returned ids stay resident until the next call
+            self._update_shards()
+
+        motion_ids = self._motion_sampler.sample(n)
         return motion_ids
 
+    def update_motion_weights(self, motion_ids, motion_weights):
+        """
+        Changes the sampling weights of a subset of motions in place, e.g. for a curriculum. The new
+        weights are relative to the current weights of the other motions, motion_weights is kept
+        normalized.
+        """
+        motion_ids = alias_sampler.to_numpy(motion_ids, np.int64).reshape(-1)
+        motion_weights = alias_sampler.to_numpy(motion_weights, np.float64).reshape(-1)
+        motion_weights = np.broadcast_to(motion_weights, motion_ids.shape)
+
+        self._raw_motion_weights[motion_ids] = motion_weights
+        weights = self._raw_motion_weights / self._raw_motion_weights.sum()
+        self.state.motion_weights.copy_(torch.tensor(weights, dtype=torch.float32))
+
+        if self._sharded:
+            self._update_shard_weights(motion_ids)
+        else:
+            self._motion_sampler.update(motion_ids, motion_weights)
+        return
+
     def sample_time(self, motion_ids, truncate_time=None):
         phase = torch.rand(motion_ids.shape, device=self._device)
 
@@ -270,32 +410,55 @@ class MotionLib(DeviceDtypeModuleMixin):
         return self.state.motion_lengths[motion_ids]
 
     def get_motion_state(self, motion_ids, motion_times):
+        if self._sharded and not bool(torch.all(self.length_starts[motion_ids] >= 0)):
+            return self._get_host_motion_state(motion_ids, motion_times)
+
+        if self._baked:
+            return self._get_baked_motion_state(motion_ids, motion_times)
+
+        f0l, f1l, blend = self._calc_frame_rows(motion_ids, motion_times, self.length_starts)
+        return self._interp_frames(self.gts, self.grs, self.lrs, self.grvs, self.gravs, self.dvs, f0l, f1l, blend)
+
+    def _get_host_motion_state(self, motion_ids, motion_times):
+        # used for clips that are not resident in sharded mode, the frames are gathered from the host copy
+        f0l, f1l, blend = self._calc_frame_rows(motion_ids, motion_times, self._host_length_starts)
+        rows = torch.cat([f0l, f1l], dim=0).cpu()
+        frames = [self._host_arrays[k][rows].to(self._device) for k in self.MOTION_ARRAYS]
+
+        n = f0l.shape[0]
+        frame_ids = torch.arange(2 * n, dtype=torch.long, device=self._device)
+        return self._interp_frames(*frames, frame_ids[:n], frame_ids[n:], blend)
+
+    def _calc_frame_rows(self, motion_ids, motion_times, length_starts):
         motion_len = self.state.motion_lengths[motion_ids]
         num_frames = self.state.motion_num_frames[motion_ids]
         dt = self.state.motion_dt[motion_ids]
 
         frame_idx0, frame_idx1, blend = self._calc_frame_blend(motion_times, motion_len, num_frames, dt)
 
-        f0l = frame_idx0 + self.length_starts[motion_ids]
-        f1l = frame_idx1 + self.length_starts[motion_ids]
+        f0l = frame_idx0 + length_starts[motion_ids]
+        f1l = frame_idx1 + length_starts[motion_ids]
 
-        root_pos0 = self.gts[f0l, 0]
-        root_pos1 = self.gts[f1l, 0]
+        return f0l, f1l, blend
 
-        root_rot0 = self.grs[f0l, 0]
-        root_rot1 = self.grs[f1l, 0]
+    def _interp_frames(self, gts, grs, lrs, grvs, gravs, dvs, f0l, f1l, blend):
+        root_pos0 = gts[f0l, 0]
+        root_pos1 = gts[f1l, 0]
 
-        local_rot0 = self.lrs[f0l]
-        local_rot1 = self.lrs[f1l]
+        root_rot0 = grs[f0l, 0]
+        root_rot1 = grs[f1l, 0]
 
-        root_vel = self.grvs[f0l]
+        local_rot0 = lrs[f0l]
+        local_rot1 = lrs[f1l]
 
-        root_ang_vel = self.gravs[f0l]
+        root_vel = grvs[f0l]
 
-        key_pos0 = self.gts[f0l.unsqueeze(-1), self._key_body_ids.unsqueeze(0)]
-        key_pos1 = self.gts[f1l.unsqueeze(-1), self._key_body_ids.unsqueeze(0)]
+        root_ang_vel = gravs[f0l]
 
-        dof_vel = self.dvs[f0l]
+        key_pos0 = gts[f0l.unsqueeze(-1), self._key_body_ids.unsqueeze(0)]
+        key_pos1 = gts[f1l.unsqueeze(-1), self._key_body_ids.unsqueeze(0)]
+
+        dof_vel = dvs[f0l]
 
         vals = [root_pos0, root_pos1, local_rot0, local_rot1, root_vel, root_ang_vel, key_pos0, key_pos1]
         for v in vals:
@@ -315,6 +478,107 @@ class MotionLib(DeviceDtypeModuleMixin):
 
         return root_pos, root_rot, dof_pos, root_vel, root_ang_vel, dof_vel, key_pos
 
+    def get_baked_frames(self, motion_ids, motion_times):
+        """
+        Returns the baked rows and blend weights for the queried times, see _bake_motion_frames for
+        the layout. Returns None if the library is not baked or some of the clips are not resident.
+        """
+        if not self._baked:
+            return None, None
+        if self._sharded and not bool(torch.all(self.length_starts[motion_ids] >= 0)):
+            return None, None
+
+        motion_len = self.state.motion_lengths[motion_ids]
+        num_frames = self.state.motion_num_frames[motion_ids]
+        dt = self.state.motion_dt[motion_ids]
+
+        frame_idx0, _, blend = self._calc_frame_blend(motion_times, motion_len, num_frames, dt)
+        f0l = frame_idx0 + self.length_starts[motion_ids]
+
+        return self.baked_frames[f0l], blend
+
+    def get_baked_pose_size(self):
+        return self._baked_pose_size
+
+    def _get_baked_motion_state(self, motion_ids, motion_times):
+        frame, blend = self.get_baked_frames(motion_ids, motion_times)
+
+        # each baked row holds the pose of a frame, the pose of the following frame and the frame's velocities
+        pose_size = self._baked_pose_size
+        pose = torch.lerp(frame[:, :pose_size], frame[:, pose_size:(2 * pose_size)], blend.unsqueeze(-1))
+        vel = frame[:, (2 * pose_size):]
+
+        num_dof = self._num_dof
+        root_pos = pose[:, 0:3]
+        root_rot = torch.nn.functional.normalize(pose[:, 3:7], dim=-1)
+        dof_pos = self._wrap_dof_pos(pose[:, 7:(7 + num_dof)])
+        key_pos = pose[:, (7 + num_dof):].view(pose.shape[0], -1, 3)
+
+        root_vel = vel[:, 0:3]
+        root_ang_vel = vel[:, 3:6]
+        dof_vel = vel[:, 6:]
+
+        return root_pos, root_rot, dof_pos, root_vel, root_ang_vel, dof_vel, key_pos
+
+    def _bake_motion_frames(self, gts, grs, lrs, grvs, gravs, dvs, length_starts, num_frames):
+        """
+        Precomputes the motion state of every frame into a single table. Each row is laid out as
+        [pose(f), pose(f + 1), vel(f)], where pose = [root_pos, root_rot, dof_pos, key_pos] and
+        vel = [root_vel, root_ang_vel, dof_vel], so a query is one gather and a linear blend.
+        """
+        total_frames = gts.shape[0]
+
+        next_frame = torch.arange(1, total_frames + 1, dtype=torch.long, device=gts.device)
+        last_frames = length_starts + num_frames - 1
+        next_frame[last_frames] = last_frames
+
+        root_pos = gts[:, 0]
+        root_rot = grs[:, 0]
+        dof_pos = self._local_rotation_to_dof(lrs)
+        key_pos = gts[:, self._key_body_ids].view(total_frames, -1)
+
+        # express the next frame in the same hemisphere / angle branch as the current frame,
+        # otherwise blending across a wrap-around would not follow the shortest path
+        next_root_rot = root_rot[next_frame]
+        next_root_rot = torch.where(torch.sum(root_rot * next_root_rot, dim=-1, keepdim=True) < 0, -next_root_rot, next_root_rot)
+        next_dof_pos = self._unwrap_dof_pos(dof_pos, dof_pos[next_frame])
+
+        pose = torch.cat([root_pos, root_rot, dof_pos, key_pos], dim=-1)
+        next_pose = torch.cat([root_pos[next_frame], next_root_rot, next_dof_pos, key_pos[next_frame]], dim=-1)
+        self._baked_pose_size = pose.shape[-1]
+
+        baked_frames = torch.cat([pose, next_pose, grvs, gravs, dvs], dim=-1)
+        return baked_frames.to(dtype=torch.float32)
+
+    def _unwrap_dof_pos(self, dof_pos, next_dof_pos):
+        next_dof_pos = next_dof_pos.clone()
+
+        exp_map = dof_pos[:, self._dof3_cols].view(dof_pos.shape[0], -1, 3)
+        next_exp_map = next_dof_pos[:, self._dof3_cols].view(dof_pos.shape[0], -1, 3)
+        next_angle = torch.norm(next_exp_map, dim=-1, keepdim=True)
+        alt_exp_map = next_exp_map * (next_angle - 2 * np.pi) / torch.clamp_min(next_angle, 1e-5)
+        use_alt = torch.norm(alt_exp_map - exp_map, dim=-1, keepdim=True) < torch.norm(next_exp_map - exp_map, dim=-1, keepdim=True)
+        next_exp_map = torch.where(use_alt, alt_exp_map, next_exp_map)
+        next_dof_pos[:, self._dof3_cols] = next_exp_map.view(dof_pos.shape[0], -1)
+
+        theta = dof_pos[:, self._dof1_cols]
+        next_theta = next_dof_pos[:, self._dof1_cols]
+        next_dof_pos[:, self._dof1_cols] = next_theta + 2 * np.pi * torch.round((theta - next_theta) / (2 * np.pi))
+
+        return next_dof_pos
+
+    def _wrap_dof_pos(self, dof_pos):
+        # maps blended dofs back to the [-pi, pi] range produced by _local_rotation_to_dof
+        dof_pos = dof_pos.clone()
+
+        exp_map = dof_pos[:, self._dof3_cols].view(dof_pos.shape[0], -1, 3)
+        angle = torch.norm(exp_map, dim=-1, keepdim=True)
+        scale = torch.where(angle > np.pi, (angle - 2 * np.pi) / torch.clamp_min(angle, 1e-5), torch.ones_like(angle))
+        dof_pos[:, self._dof3_cols] = (exp_map * scale).view(dof_pos.shape[0], -1)
+        dof_pos[:, self._dof1_cols] = normalize_angle(dof_pos[:, self._dof1_cols])
+
+        return dof_pos
+
     def _load_motions(self, motion_file):
         self._motions = []
         self._motion_lengths = []
@@ -328,10 +592,13 @@ class MotionLib(DeviceDtypeModuleMixin):
 
         motion_files, motion_weights = self._fetch_motion_files(motion_file)
         num_motion_files = len(motion_files)
+        # in sharded mode the clips are only needed on the host
+        cache_device = "cpu" if self._sharded else self._device
+        loaded_motions = self._iter_motion_files(motion_files)
         for f in range(num_motion_files):
             curr_file = motion_files[f]
             print("Loading {:d}/{:d} motion files: {:s}".format(f + 1, num_motion_files, curr_file))
-            curr_motion = SkeletonMotion.from_file(curr_file)
+            curr_motion = next(loaded_motions)
 
             motion_fps = curr_motion.fps
             curr_dt = 1.0 / motion_fps
@@ -343,17 +610,22 @@ class MotionLib(DeviceDtypeModuleMixin):
             self._motion_dt.append(curr_dt)
             self._motion_num_frames.append(num_frames)
  
-            curr_dof_vels = self._compute_motion_dof_vels(curr_motion)
-            curr_motion.dof_vels = curr_dof_vels
-
-            # Moving motion tensors to the GPU
-            if USE_CACHE:
-                curr_motion = DeviceCache(curr_motion, self._device)                
+            if isinstance(curr_motion, DeviceCache):
+                # loaded by a worker, the dof velocities are computed from the original double precision clip
+                curr_motion.obj.dof_vels = self._compute_motion_dof_vels(curr_motion.obj)
+                curr_motion = curr_motion.to(cache_device)
             else:
-                curr_motion.tensor = curr_motion.tensor.to(self._device)
-                curr_motion._skeleton_tree._parent_indices = curr_motion._skeleton_tree._parent_indices.to(self._device)
-                curr_motion._skeleton_tree._local_translation = curr_motion._skeleton_tree._local_translation.to(self._device)
-                curr_motion._rotation = curr_motion._rotation.to(self._device)
+                curr_dof_vels = self._compute_motion_dof_vels(curr_motion)
+                curr_motion.dof_vels = curr_dof_vels
+
+                # Moving motion tensors to the GPU
+                if USE_CACHE:
+                    curr_motion = DeviceCache(curr_motion, cache_device)
+                else:
+                    curr_motion.tensor = curr_motion.tensor.to(self._device)
+                    curr_motion._skeleton_tree._parent_indices = curr_motion._skeleton_tree._parent_indices.to(self._device)
+                    curr_motion._skeleton_tree._local_translation = curr_motion._skeleton_tree._local_translation.to(self._device)
+                    curr_motion._rotation = curr_motion._rotation.to(self._device)
 
             self._motions.append(curr_motion)
             self._motion_lengths.append(curr_len)
@@ -392,6 +664,289 @@ class MotionLib(DeviceDtypeModuleMixin):
 
         return motion_files
 
+    def _init_shards(self, motion_arrays, host_length_starts, shard_frames, resident_shards, shard_swap_interval):
+        """
+        Sharded mode keeps the full motion arrays on the host and only a working set of shards
+        on the device. Shards are groups of consecutive clips with at most shard_frames frames.
+        Each of the resident slots holds a shard drawn with probability proportional to its total
+        weight, and clips are sampled from a slot with their weight relative to the shard, so the
+        clip distribution matches the motion weights in expectation. Every shard_swap_interval
+        calls to sample_motions, the oldest slot is replaced by a shard that was read into pinned
+        host memory in the background.
+        """
+        num_motions = self.num_motions()
+        num_frames = self.state.motion_num_frames.cpu().numpy()
+        motion_weights = self.state.motion_weights.cpu().numpy()
+
+        self._host_arrays = {k: motion_arrays[k].to(dtype=torch.float32) for k in self.MOTION_ARRAYS}
+        host_length_starts = host_length_starts.cpu()
+
+        shard_motions = []
+        shard_start = 0
+        shard_size = 0
+        for m in range(num_motions):
+            if (m > shard_start and shard_size + num_frames[m] > shard_frames):
+                shard_motions.append((shard_start, m))
+                shard_start = m
+                shard_size = 0
+            shard_size += num_frames[m]
+        shard_motions.append((shard_start, num_motions))
+
+        self._shard_motions = shard_motions
+        self._motion_shards = np.concatenate([np.full(m1 - m0, i, dtype=np.int64) for i, (m0, m1) in enumerate(shard_motions)])
+        self._shard_frames = [(int(host_length_starts[m0]), int(host_length_starts[m1 - 1] + num_frames[m1 - 1]))
+                              for m0, m1 in shard_motions]
+        self._shard_weights = torch.tensor([motion_weights[m0:m1].sum() for m0, m1 in shard_motions], dtype=torch.float64)
+
+        num_shards = len(shard_motions)
+        self._num_resident_shards = min(resident_shards, num_shards)
+        self._shard_rows = max([f1 - f0 for f0, f1 in self._shard_frames])
+        self._shard_swap_interval = shard_swap_interval
+        self._shard_sample_count = 0
+        self._next_slot = 0
+        self._slot_shards = [-1] * self._num_resident_shards
+
+        num_rows = self._num_resident_shards * self._shard_rows
+        for k in self.MOTION_ARRAYS:
+            host_array = self._host_arrays[k]
+            self.register_buffer(
+                k,
+                torch.zeros((num_rows,) + host_array.shape[1:], dtype=torch.float32, device=self._device),
+                persistent=False,
+            )
+
+        if self._baked:
+            self._baked_pose_size = 7 + self._num_dof + 3 * len(self._key_body_id_list)
+            num_cols = 2 * self._baked_pose_size + 6 + self._num_dof
+            self.register_buffer(
+                "baked_frames",
+                torch.zeros((num_rows, num_cols), dtype=torch.float32, device=self._device),
+                persistent=False,
+            )
+
+        # row of the first frame of every clip within the resident buffers, -1 if the clip is not resident
+        self.register_buffer(
+            "length_starts",
+            torch.full((num_motions,), -1, dtype=torch.long, device=self._device),
+            persistent=False,
+        )
+        self.register_buffer(
+            "_host_length_starts", host_length_starts.to(self._device), persistent=False
+        )
+        self.register_buffer(
+            "_resident_motion_weights",
+            torch.zeros((num_motions,), dtype=torch.float32, device=self._device),
+            persistent=False,
+        )
+
+        use_pinned_memory = torch.device(self._device).type == "cuda"
+        self._shard_staging = {
+            k: torch.zeros((self._shard_rows,) + self._host_arrays[k].shape[1:], dtype=torch.float32,
+                           pin_memory=use_pinned_memory)
+            for k in self.MOTION_ARRAYS
+        }
+        self._staging_event = torch.cuda.Event() if use_pinned_memory else None
+        self._shard_executor = ThreadPoolExecutor(max_workers=1)
+        self._shard_prefetch = None
+
+        print("Sharded {:d} motions into {:d} shards of up to {:d} frames, {:d} resident".format(
+              num_motions, num_shards, self._shard_rows, self._num_resident_shards))
+        return
+
+    def _fill_shards(self):
+        shards = torch.multinomial(self._shard_weights, self._num_resident_shards, replacement=True)
+        for slot in range(self._num_resident_shards):
+            shard = int(shards[slot])
+            f0, f1 = self._shard_frames[shard]
+            frames = {k: self._host_arrays[k][f0:f1] for k in self.MOTION_ARRAYS}
+            self._write_shard(slot, shard, frames)
+
+        self._prefetch_shard()
+        return
+
+    def _update_shards(self):
+        self._shard_sample_count += 1
+        if (self._shard_swap_interval > 0 and self._shard_sample_count % self._shard_swap_interval == 0):
+            shard, frames = self._shard_prefetch.result()
+
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self._num_resident_shards
+            self._write_shard(slot, shard, frames)
+
+            if self._staging_event is not None:
+                self._staging_event.record()
+            self._prefetch_shard()
+        return
+
+    def _prefetch_shard(self):
+        # the shard is drawn on the main thread, so that the random number stream stays deterministic
+        shard = int(torch.multinomial(self._shard_weights, 1))
+        self._shard_prefetch = self._shard_executor.submit(self._read_shard, shard)
+        return
+
+    def _read_shard(self, shard):
+        # runs on the prefetch thread, the staging buffers are reused once the previous copy to the device is done
+        if self._staging_event is not None:
+            self._staging_event.synchronize()
+
+        f0, f1 = self._shard_frames[shard]
+        frames = dict()
+        for k in self.MOTION_ARRAYS:
+            staging = self._shard_staging[k][:(f1 - f0)]
+            staging.copy_(self._host_arrays[k][f0:f1])
+            frames[k] = staging
+
+        return shard, frames
+
+    def _write_shard(self, slot, shard, frames):
+        f0, f1 = self._shard_frames[shard]
+        row0 = slot * self._shard_rows
+        row1 = row0 + f1 - f0
+        for k in self.MOTION_ARRAYS:
+            getattr(self, k)[row0:row1].copy_(frames[k], non_blocking=True)
+
+        m0, m1 = self._shard_motions[shard]
+        local_starts = self._host_length_starts[m0:m1] - f0
+        if self._baked:
+            self.baked_frames[row0:row1] = self._bake_motion_frames(
+                self.gts[row0:row1], self.grs[row0:row1], self.lrs[row0:row1],
+                self.grvs[row0:row1], self.gravs[row0:row1], self.dvs[row0:row1],
+                local_starts, self.state.motion_num_frames[m0:m1])
+
+        prev_shard = self._slot_shards[slot]
+        self._slot_shards[slot] = shard
+        for s in set([prev_shard, shard]):
+            if (s >= 0):
+                self._update_resident_shard(s)
+        return
+
+    def _update_resident_shard(self, shard):
+        m0, m1 = self._shard_motions[shard]
+        f0, _ = self._shard_frames[shard]
+        slots = [i for i, s in enumerate(self._slot_shards) if s == shard]
+
+        if (len(slots) > 0):
+            self.length_starts[m0:m1] = self._host_length_starts[m0:m1] - f0 + slots[0] * self._shard_rows
+        else:
+            self.length_starts[m0:m1] = -1
+
+        # a shard can occupy several slots, each of them contributes w / (W_shard * num_slots)
+        shard_weight = max(float(self._shard_weights[shard]), 1e-12)
+        scale = len(slots) / (shard_weight * self._num_resident_shards)
+        self._resident_motion_weights[m0:m1] = self.state.motion_weights[m0:m1] * scale
+
+        if self._motion_sampler is not None:
+            self._motion_sampler.update(self.motion_ids[m0:m1], self._resident_motion_weights[m0:m1])
+        return
+
+    def _update_shard_weights(self, motion_ids):
+        shard_starts = [m0 for m0, _ in self._shard_motions]
+        motion_weights = self.state.motion_weights.cpu().numpy().astype(np.float64)
+        self._shard_weights = torch.tensor(np.add.reduceat(motion_weights, shard_starts), dtype=torch.float64)
+
+        # the weights of other shards relative to their shard total are not affected by the renormalization
+        shards = np.unique(self._motion_shards[motion_ids])
+        for shard in shards:
+            if (shard in self._slot_shards):
+                self._update_resident_shard(int(shard))
+        return
+
+    def _release_motion_caches(self, motions):
+        # the per-clip copies are no longer needed once they have been concatenated into the buffers
+        num_bytes = sum([m.num_bytes for m in motions])
+        load_time = sum([m.load_time for m in motions])
+        skipped_keys = motions[0].get_skipped_keys()
+        print("Cached {:d} motion fields per clip ({:.1f} MB, {:.3f}s), skipped {:d} unused clip properties: {:s}".format(
+              len(DeviceCache.CACHED_KEYS), num_bytes / (1024 * 1024), load_time, len(skipped_keys), ", ".join(skipped_keys)))
+
+        for m in motions:
+            m.release()
+        return
+
+    def _iter_motion_files(self, motion_files):
+        if (self._num_workers > 0 and USE_CACHE):
+            # the workers take seconds to start, so the pool only pays off on multi-core hosts with many clips.
+            # spawn, since the parent process may already hold a cuda context
+            mp_context = multiprocessing.get_context("spawn")
+            chunksize = max(1, len(motion_files) // (4 * self._num_workers))
+            with ProcessPoolExecutor(max_workers=self._num_workers, mp_context=mp_context,
+                                     initializer=_init_motion_load_worker) as executor:
+                # map returns the results in the order of motion_files
+                for curr_motion in executor.map(_load_motion_file, motion_files, chunksize=chunksize):
+                    yield curr_motion
+        else:
+            for curr_file in motion_files:
+                yield SkeletonMotion.from_file(curr_file)
+        return
+
+    def _load_motion_pack(self, pack_file):
+        print("Loading motion pack: {:s}".format(pack_file))
+        header, arrays = motion_pack.load_motion_pack(pack_file)
+
+        # lengths and dts are computed in double precision, same as when loading the clips
+        fps = torch.from_numpy(np.array(arrays["motion_fps"], dtype=np.float64))
+        num_frames = torch.from_numpy(np.array(arrays["motion_num_frames"], dtype=np.int64))
+        motion_fps = fps.to(device=self._device, dtype=torch.float32)
+        motion_dt = (1.0 / fps).to(device=self._device, dtype=torch.float32)
+        motion_num_frames = num_frames.to(self._device)
+        motion_lengths = (1.0 / fps * (num_frames - 1)).to(device=self._device, dtype=torch.float32)
+
+        if self._equal_motion_weights:
+            motion_weights = torch.ones_like(motion_fps)
+        else:
+            motion_weights = torch.from_numpy(np.array(arrays["motion_weights"])).to(device=self._device, dtype=torch.float32)
+        motion_weights /= motion_weights.sum()
+
+        self._motions = []
+        self._motion_lengths = motion_lengths
+        self._motion_weights = motion_weights
+        self._motion_fps = motion_fps
+        self._motion_dt = motion_dt
+        self._motion_num_frames = motion_num_frames
+
+        motion_files = list(header["motion_files"])
+        self._motion_files = motion_files
+        self.state = LoadedMotions(
+            motions=tuple(),
+            motion_lengths=motion_lengths,
+            motion_weights=motion_weights,
+            motion_fps=motion_fps,
+            motion_dt=motion_dt,
+            motion_num_frames=motion_num_frames,
+            motion_files=tuple(motion_files),
+        )
+
+        motion_arrays = {k: torch.from_numpy(arrays[k]) for k in self.MOTION_ARRAYS}
+
+        dof_body_ids = [int(i) for i in self._dof_body_ids]
+        dof_offsets = [int(i) for i in self._dof_offsets]
+        if (header["dof_body_ids"] != dof_body_ids or header["dof_offsets"] != dof_offsets):
+            print("Motion pack was built for a different dof config, recomputing dof velocities")
+            motion_arrays["dvs"] = self._compute_packed_dof_vels(motion_arrays["lrs"], motion_num_frames.cpu(), motion_dt.cpu())
+
+        num_motions = self.num_motions()
+        total_len = self.get_total_length()
+        print("Loaded {:d} motions with a total length of {:.3f}s.".format(num_motions, total_len))
+
+        return motion_files, motion_arrays
+
+    def save_motion_pack(self, pack_file):
+        if self._sharded:
+            arrays = {k: self._host_arrays[k].numpy() for k in self.MOTION_ARRAYS}
+            arrays["length_starts"] = self._host_length_starts.cpu().numpy()
+        else:
+            arrays = {k: getattr(self, k).cpu().numpy() for k in self.MOTION_ARRAYS}
+            arrays["length_starts"] = self.length_starts.cpu().numpy()
+        arrays["motion_num_frames"] = self.state.motion_num_frames.cpu().numpy().astype(np.int64)
+        if (len(self.state.motions) > 0):
+            arrays["motion_fps"] = np.array([m.fps for m in self.state.motions], dtype=np.float64)
+        else:
+            arrays["motion_fps"] = self.state.motion_fps.cpu().numpy()
+        arrays["motion_weights"] = self.state.motion_weights.cpu().numpy()
+
+        motion_pack.write_motion_pack(pack_file, arrays, self.motion_files, self._dof_body_ids, self._dof_offsets)
+        return
+
     def _fetch_motion_files(self, motion_file):
         ext = os.path.splitext(motion_file)[1]
         if (ext == ".yaml"):
@@ -429,84 +984,85 @@ class MotionLib(DeviceDtypeModuleMixin):
         return frame_idx0, frame_idx1, blend
 
     def _get_num_bodies(self):
-        motion = self.get_motion(0)
-        num_bodies = motion.num_joints
+        num_bodies = self.lrs.shape[1]
         return num_bodies
 
+    def _build_dof_index(self, dof_body_ids, dof_offsets):
+        # splits the joints by type once, so that rotations can be converted to dofs
+        # for all joints of a type with a single gather / scatter
+        dof3_body_ids = []
+        dof3_cols = []
+        dof1_body_ids = []
+        dof1_cols = []
+
+        for j in range(len(dof_body_ids)):
+            body_id = dof_body_ids[j]
+            joint_offset = dof_offsets[j]
+            joint_size = dof_offsets[j + 1] - joint_offset
+
+            if (joint_size == 3):
+                dof3_body_ids.append(body_id)
+                dof3_cols += list(range(joint_offset, joint_offset + joint_size))
+            elif (joint_size == 1):
+                dof1_body_ids.append(body_id)
+                dof1_cols.append(joint_offset)
+            else:
+                print("Unsupported joint type")
+                assert(False)
+
+        self.register_buffer("_dof3_body_ids", torch.tensor(dof3_body_ids, dtype=torch.long), persistent=False)
+        self.register_buffer("_dof3_cols", torch.tensor(dof3_cols, dtype=torch.long), persistent=False)
+        self.register_buffer("_dof1_body_ids", torch.tensor(dof1_body_ids, dtype=torch.long), persistent=False)
+        self.register_buffer("_dof1_cols", torch.tensor(dof1_cols, dtype=torch.long), persistent=False)
+        return
+
     def _compute_motion_dof_vels(self, motion):
         num_frames = motion.tensor.shape[0]
         dt = 1.0 / motion.fps
-        dof_vels = []
-
-        for f in range(num_frames - 1):
-            local_rot0 = motion.local_rotation[f]
-            local_rot1 = motion.local_rotation[f + 1]
-            frame_dof_vel = self._local_rotation_to_dof_vel(local_rot0, local_rot1, dt)
-            frame_dof_vel = frame_dof_vel
-            dof_vels.append(frame_dof_vel)
-        
-        dof_vels.append(dof_vels[-1])
-        dof_vels = torch.stack(dof_vels, dim=0)
+
+        local_rot = motion.local_rotation
+        dof_vels = self._local_rotation_to_dof_vel(local_rot[:(num_frames - 1)], local_rot[1:], dt)
+        dof_vels = torch.cat([dof_vels, dof_vels[-1:]], dim=0)
 
         return dof_vels
-    
-    def _local_rotation_to_dof(self, local_rot):
-        body_ids = self._dof_body_ids
-        dof_offsets = self._dof_offsets
 
-        n = local_rot.shape[0]
-        dof_pos = torch.zeros((n, self._num_dof), dtype=torch.float, device=self._device)
+    def _compute_packed_dof_vels(self, lrs, num_frames, dt):
+        # dof velocities of all clips at once, pairs of frames spanning two clips are overwritten below
+        # computed in double precision, since the clips are stored as doubles when they are loaded from .npy files
+        lrs = lrs.double()
+        frame_dt = torch.repeat_interleave(dt.double(), num_frames)
+        dof_vels = self._local_rotation_to_dof_vel(lrs[:-1], lrs[1:], frame_dt[:-1].view(-1, 1, 1))
+        dof_vels = torch.cat([dof_vels, dof_vels[-1:]], dim=0)
 
-        for j in range(len(body_ids)):
-            body_id = body_ids[j]
-            joint_offset = dof_offsets[j]
-            joint_size = dof_offsets[j + 1] - joint_offset
+        last_frames = torch.cumsum(num_frames, dim=0) - 1
+        dof_vels[last_frames] = dof_vels[last_frames - 1]
 
-            if (joint_size == 3):
-                joint_q = local_rot[:, body_id]
-                joint_exp_map = torch_utils.quat_to_exp_map(joint_q)
-                dof_pos[:, joint_offset:(joint_offset + joint_size)] = joint_exp_map
-            elif (joint_size == 1):
-                joint_q = local_rot[:, body_id]
-                joint_theta, joint_axis = torch_utils.quat_to_angle_axis(joint_q)
-                joint_theta = joint_theta * joint_axis[..., 1] # assume joint is always along y axis
+        return dof_vels
 
-                joint_theta = normalize_angle(joint_theta)
-                dof_pos[:, joint_offset] = joint_theta
+    def _local_rotation_to_dof(self, local_rot):
+        batch_shape = local_rot.shape[:-2]
+        dof_pos = torch.zeros(batch_shape + (self._num_dof,), dtype=torch.float, device=local_rot.device)
 
-            else:
-                print("Unsupported joint type")
-                assert(False)
+        joint_q = local_rot[..., self._dof3_body_ids, :]
+        joint_exp_map = torch_utils.quat_to_exp_map(joint_q)
+        dof_pos[..., self._dof3_cols] = joint_exp_map.reshape(batch_shape + (-1,)).to(dof_pos.dtype)
+
+        joint_q = local_rot[..., self._dof1_body_ids, :]
+        joint_theta, joint_axis = torch_utils.quat_to_angle_axis(joint_q)
+        joint_theta = joint_theta * joint_axis[..., 1] # assume joint is always along y axis
+        dof_pos[..., self._dof1_cols] = normalize_angle(joint_theta).to(dof_pos.dtype)
 
         return dof_pos
 
     def _local_rotation_to_dof_vel(self, local_rot0, local_rot1, dt):
-        body_ids = self._dof_body_ids
-        dof_offsets = self._dof_offsets
-
-        dof_vel = torch.zeros([self._num_dof], device=self._device)
+        batch_shape = local_rot0.shape[:-2]
+        dof_vel = torch.zeros(batch_shape + (self._num_dof,), dtype=torch.float, device=local_rot0.device)
 
         diff_quat_data = quat_mul_norm(quat_inverse(local_rot0), local_rot1)
         diff_angle, diff_axis = quat_angle_axis(diff_quat_data)
-        local_vel = diff_axis * diff_angle.unsqueeze(-1) / dt
-        local_vel = local_vel
+        local_vel = (diff_axis * diff_angle.unsqueeze(-1) / dt).to(dof_vel.dtype)
 
-        for j in range(len(body_ids)):
-            body_id = body_ids[j]
-            joint_offset = dof_offsets[j]
-            joint_size = dof_offsets[j + 1] - joint_offset
-
-            if (joint_size == 3):
-                joint_vel = local_vel[body_id]
-                dof_vel[joint_offset:(joint_offset + joint_size)] = joint_vel
-
-            elif (joint_size == 1):
-                assert(joint_size == 1)
-                joint_vel = local_vel[body_id]
-                dof_vel[joint_offset] = joint_vel[1] # assume joint is always along y axis
-
-            else:
-                print("Unsupported joint type")
-                assert(False)
+        dof_vel[..., self._dof3_cols] = local_vel[..., self._dof3_body_ids, :].reshape(batch_shape + (-1,))
+        dof_vel[..., self._dof1_cols] = local_vel[..., self._dof1_body_ids, 1] # assume joint is always along y axis
 
-        return dof_vel
\ No newline at end of file
+        return dof_vel
@@ -0,0 +1,126 @@
+# Copyright (c) 2018-2022, NVIDIA Corporation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import os
+import struct
+
+import numpy as np
+
+"""
+Packed motion dataset format. A pack stores the concatenated per-frame arrays of all clips
+of a motion dataset, so they can be memory mapped instead of being re-derived from every
+clip on every run.
+
+Layout: 8 byte magic, uint64 header size, json header, then the raw arrays, each aligned
+to ALIGNMENT bytes. The header lists the dtype, shape and offset of every array, along with
+the clip files and the dof config that were used to compute the dof velocities.
+"""
+
+MOTION_PACK_EXT = ".motionpack"
+MOTION_PACK_VERSION = 1
+
+MAGIC = b"CALMPACK"
+ALIGNMENT = 64
+
+def is_motion_pack(motion_file):
+    ext = os.path.splitext(motion_file)[1]
+    return ext == MOTION_PACK_EXT
+
+def write_motion_pack(pack_file, arrays, motion_files, dof_body_ids, dof_offsets):
+    header = {
+        "version": MOTION_PACK_VERSION,
+        "motion_files": list(motion_files),
+        "dof_body_ids": [int(i) for i in dof_body_ids],
+        "dof_offsets": [int(i) for i in dof_offsets],
+        "arrays": {},
+    }
+
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+
+    offset = 0
+    for k, v in arrays.items():
+        offset = _align(offset)
+        header["arrays"][k] = {
+            "dtype": v.dtype.str,
+            "shape": list(v.shape),
+            "offset": offset,
+        }
+        offset += v.nbytes
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+    header_bytes = header_bytes.ljust(data_start - len(MAGIC) - 8)
+
+    tmp_file = "{:s}.{:d}.tmp".format(pack_file, os.getpid())
+    with open(tmp_file, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for k, v in arrays.items():
+            f.seek(data_start + header["arrays"][k]["offset"])
+            f.write(v.tobytes())
+
+    # write to a temporary file first, so that an interrupted write never leaves a truncated pack behind
+    os.replace(tmp_file, pack_file)
+    return
+
+def load_motion_pack(pack_file):
+    with open(pack_file, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if (magic != MAGIC):
+            raise ValueError("Not a motion pack: {:s}".format(pack_file))
+
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size).decode("utf-8"))
+
+    if (header["version"] != MOTION_PACK_VERSION):
+        raise ValueError("Unsupported motion pack version {:d} in {:s}, expected {:d}".format(
+                         header["version"], pack_file, MOTION_PACK_VERSION))
+
+    data_start = len(MAGIC) + 8 + header_size
+    file_size = os.path.getsize(pack_file)
+
+    arrays = dict()
+    for k, desc in header["arrays"].items():
+        dtype = np.dtype(desc["dtype"])
+        shape = tuple(desc["shape"])
+        offset = data_start + desc["offset"]
+        if (offset + dtype.itemsize * int(np.prod(shape)) > file_size):
+            raise ValueError("Truncated motion pack: {:s}".format(pack_file))
+
+        if (np.prod(shape) == 0):
+            arrays[k] = np.zeros(shape, dtype=dtype)
+        else:
+            # copy-on-write, so that the arrays can be wrapped as writable tensors without touching the file
+            arrays[k] = np.memmap(pack_file, dtype=dtype, mode="c", offset=offset, shape=shape)
+
+    return header, arrays
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT